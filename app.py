@@ -7,5 +7,5 @@ game = win.Game()
 fsc = win.MenuScreen(game)
 game.change_screen(fsc)
 
-while True:
+while game.running:
     game.tick()
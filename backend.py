@@ -0,0 +1,198 @@
+import math
+
+class TurtleBackend:
+    """ Backend drawing the game in a Tk window with the turtle module.
+    """
+    def __init__(self):
+        import turtle
+        self.turtle = turtle
+        self.Turtle = turtle.Turtle
+        self.closed = False
+
+    def setup(self, width, height, title):
+        self.turtle.setup(width, height)
+        self.turtle.title(title)
+        self.turtle.tracer(0)
+        self.turtle.ht()
+        self.turtle.penup()
+        self.turtle.setundobuffer(0)
+
+    def update(self):
+        self.turtle.update()
+
+    def clearscreen(self, width, height):
+        self.turtle.clearscreen()
+        self.turtle.setworldcoordinates(0, 0, width, height)
+
+    def bgcolor(self, color):
+        self.turtle.bgcolor(color)
+
+    def onkey(self, fun, key):
+        self.turtle.onkey(fun, key)
+
+    def listen(self):
+        self.turtle.listen()
+
+    def textinput(self, title, prompt):
+        return self.turtle.textinput(title, prompt)
+
+    def bye(self):
+        self.closed = True
+        self.turtle.bye()
+
+class HeadlessTurtle:
+    """ A stand-in for Turtle which draws nothing, but keeps track of
+    its position, heading and visibility.
+    """
+    def __init__(self, shape="classic", undobuffersize=0, visible=True):
+        self._shape = shape
+        self._x = 0.0
+        self._y = 0.0
+        self._heading = 0.0
+        self._visible = visible
+
+    def xcor(self):
+        return self._x
+
+    def ycor(self):
+        return self._y
+
+    def pos(self):
+        return (self._x, self._y)
+
+    def goto(self, x, y=None):
+        if y is None:
+            x, y = x
+        self._x = float(x)
+        self._y = float(y)
+
+    def heading(self):
+        return self._heading
+
+    def setheading(self, angle):
+        self._heading = angle % 360.0
+
+    def left(self, angle):
+        self.setheading(self._heading + angle)
+
+    def right(self, angle):
+        self.setheading(self._heading - angle)
+
+    def forward(self, distance):
+        angle = math.radians(self._heading)
+        self._x += round(math.cos(angle), 10) * distance
+        self._y += round(math.sin(angle), 10) * distance
+
+    def isvisible(self):
+        return self._visible
+
+    def showturtle(self):
+        self._visible = True
+
+    def hideturtle(self):
+        self._visible = False
+
+    def shape(self, name=None):
+        if name is None:
+            return self._shape
+        self._shape = name
+
+    def nothing(self, *args, **kwargs):
+        pass
+
+    fd = forward
+    lt = left
+    rt = right
+    seth = setheading
+    setpos = setposition = goto
+    st = showturtle
+    ht = hideturtle
+    speed = color = fillcolor = pencolor = pensize = shapesize = turtlesize = \
+        penup = pendown = write = clear = begin_fill = end_fill = nothing
+
+class HeadlessBackend:
+    """ Backend running the game without a display. Keybinds are kept so
+    press() can fire them, and textinput() answers from a list.
+    """
+    Turtle = HeadlessTurtle
+
+    def __init__(self, answers=None):
+        self.answers = list(answers or [])
+        self.keybinds = {}
+        self.bgcolor_name = "white"
+        self.closed = False
+
+    def setup(self, width, height, title):
+        pass
+
+    def update(self):
+        pass
+
+    def clearscreen(self, width, height):
+        self.keybinds = {}
+
+    def bgcolor(self, color):
+        self.bgcolor_name = color
+
+    def onkey(self, fun, key):
+        self.keybinds[key] = fun
+
+    def listen(self):
+        pass
+
+    def textinput(self, title, prompt):
+        if not self.answers:
+            return None
+        return self.answers.pop(0)
+
+    def bye(self):
+        self.closed = True
+
+    def press(self, key):
+        """ Fires the function bound to a key, like a key press would.
+        """
+        if key in self.keybinds:
+            self.keybinds[key]()
+
+class Sprite:
+    """ Base for game objects drawn by a turtle of the game's backend.
+    Turtle methods the object does not define are passed to its turtle.
+    """
+    def __init__(self, root, shape="classic", visible=True):
+        self.pen = root.backend.Turtle(shape, 0, visible)
+
+    def __getattr__(self, name):
+        if name == "pen":
+            raise AttributeError(name)
+        return getattr(self.pen, name)
+
+class TurtlePool:
+    """ Keeps hidden turtles of a backend by shape so they can be reused,
+    since making a turtle costs far more than moving one. Every turtle
+    belongs to the screen, so a pool must be dropped after clearscreen().
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.free = {}
+
+    def acquire(self, shape="classic"):
+        """ Takes a hidden turtle of a shape, or makes a new one.
+        """
+        pens = self.free.get(shape)
+        if pens:
+            pen = pens.pop()
+        else:
+            pen = self.backend.Turtle(shape, 0, False)
+        pen.speed(0)
+        pen.penup()
+        pen.pensize(1)
+        pen.shapesize(1, 1)
+        return pen
+
+    def release(self, pen):
+        """ Clears and hides a turtle, and keeps it for later.
+        """
+        pen.clear()
+        pen.penup()
+        pen.hideturtle()
+        self.free.setdefault(pen.shape(), []).append(pen)
@@ -1,21 +1,87 @@
 from random import Random, choice
 from time import time_ns
+from collections import OrderedDict
+from operator import add
+from array import array
+import re
+import struct
+import zlib
 import items
 
+# Bumped whenever the same seed would generate a different world. Worlds
+# of older versions can still be generated, for the saves made with them.
+GENERATOR_VERSION = 2
+
+# Biome ids, as stored in the biome map of a world.
+SPAWN, WATER, GRASSLAND, PLATEAU, FOREST, MOUNTAINS, JUNGLE, SNOW, DESERT = range(9)
+BIOME_COLORS = ("#89D900", "#64B0FE", "#89D900", "#EB9F23", "#0D9400",
+                "#666666", "#004F08", "#48CEDF", "#E5E695")
+
+# Colours of every value of a layer when the world map is exported.
+LAYER_COLORS = {"island": ("#89D900", "#64B0FE"),
+                "tier": ("#FFFFFF", "#AAAAAA", "#555555", "#000000"),
+                "biome": BIOME_COLORS}
+SPAWN_COLOR = "#FF0000"
+
 class GameWorld:
     """ World class for sandboxing and simulating a game world.
-    The world generation is based on Cellular Automata.
+    The world generation is based on Cellular Automata. generator is
+    the GENERATOR_VERSION to generate the world of a seed with.
     """
-    def __init__(self, seed=""):
+    def __init__(self, seed="", engine="array", size=24, tiers=(4, 8, 12),
+                 generator=GENERATOR_VERSION):
         self.seed = seed
-        self.__size = 24
+        self.engine = engine
+        self.size = size
+        self.tiers = tiers
+        self.generator = generator
         self.__prng = Random(self.seed)
+        self.regions = RegionCache()
+        self.generate()
+
+    def generate(self):
+        """ Generates every layer of the world at once.
+        """
         self.__islandmap = self.gen_geography()
+        self.__components = None
         self.spawnpoint = self.select_spawnpoint()
-        self.__tiermap = self.scale_tiers()
-        self.__biomemap = self.populate_biomes()
+        everywhere = range(self.__size)
+        self.__tiermap = self.scale_tiers(everywhere, everywhere)
+        self.__biomemap = self.populate_biomes(self.__islandmap, self.__tiermap,
+                                               everywhere, everywhere)
         self.itemmap = self.place_items()
 
+    @classmethod
+    def from_layers(cls, seed, tiers, spawnpoint, layers, itemmap, prng_state,
+                    generator=GENERATOR_VERSION):
+        """ Rebuilds an already generated world without generating it again.
+        layers are the island, tier and biome maps as from get_layers().
+        """
+        world = cls.__new__(cls)
+        world.seed = seed
+        world.engine = "array"
+        world.size = len(layers[0])
+        world.tiers = tiers
+        world.generator = generator
+        world.__prng = Random()
+        world.__prng.setstate(prng_state)
+        world.__islandmap, world.__tiermap, world.__biomemap = layers
+        world.__components = None
+        world.spawnpoint = list(spawnpoint)
+        world.itemmap = itemmap
+        world.regions = RegionCache()
+        return world
+
+    def get_layers(self):
+        return self.__islandmap, self.__tiermap, self.__biomemap
+
+    @property
+    def itemmap(self):
+        return self.__itemmap
+    @itemmap.setter
+    def itemmap(self, itemmap):
+        self.__itemmap = ItemMap(itemmap)
+
     @property
     def seed(self):
         return self.__seed
@@ -27,6 +93,52 @@ class GameWorld:
             seed = self.gen_seed()
         self.__seed = seed
 
+    @property
+    def engine(self):
+        return self.__engine
+    @engine.setter
+    def engine(self, engine):
+        if engine not in ["classic", "array"]:
+            raise ValueError(f"Unknown world engine: {engine}")
+        self.__engine = engine
+
+    @property
+    def size(self):
+        return self.__size
+    @size.setter
+    def size(self, size):
+        if not isinstance(size, int):
+            raise TypeError("size must be integer")
+        if size < 12:
+            raise ValueError("size must be at least 12")
+        self.__size = size
+
+    @property
+    def generator(self):
+        return self.__generator
+    @generator.setter
+    def generator(self, generator):
+        if generator not in range(1, GENERATOR_VERSION + 1):
+            raise ValueError(f"Unknown generator version: {generator}")
+        self.__generator = generator
+
+    @property
+    def tiers(self):
+        return self.__tiers
+    @tiers.setter
+    def tiers(self, tiers):
+        """ The distances from the spawnpoint at which tiers 1, 2 and 3 begin.
+        """
+        tiers = tuple(tiers)
+        if len(tiers) != 3 or not all(isinstance(t, int) for t in tiers):
+            raise TypeError("tiers must be three integers")
+        if not 0 <= tiers[0] < tiers[1] < tiers[2] < 255:
+            raise ValueError("tiers must be increasing distances")
+        self.__tiers = tiers
+        # Tier of every distance, anything further is the last tier.
+        self.__tierscale = bytes(sum(d > t for t in tiers)
+                                 for d in range(tiers[2] + 2))
+
     def get_prng(self):
         return self.__prng
 
@@ -40,70 +152,106 @@ class GameWorld:
     def gen_geography(self):
         """ Generates a new world map using Cellular Automata.
         """
-        worldmap = CellAutoIsland(self.__size, self.__size, self.__prng)
-        return worldmap.map
+        if self.engine == "classic":
+            worldmap = CellAutoIsland(self.__size, self.__size, self.__prng)
+        else:
+            worldmap = ArrayCellAutoIsland(self.__size, self.__size, self.__prng)
+        return [bytearray(row) for row in worldmap.map]
 
     def select_spawnpoint(self):
-        """ Chooses a suitable spawnpoint.
+        """ Chooses a suitable spawnpoint, on land with enough room
+        around it to reach every item without a Raft. Version 1 worlds
+        take the first land region of a random search instead.
         """
-        while True:
-            x = self.__prng.randint(6,self.__size - 6)
-            y = self.__prng.randint(6,self.__size - 6)
-            if not self.__islandmap[x][y]:
-                return [x, y]
+        if self.generator < 2:
+            while True:
+                x = self.__prng.randint(6, self.__size - 6)
+                y = self.__prng.randint(6, self.__size - 6)
+                if not self.is_water(x, y):
+                    return [x, y]
+        components = self.get_components()
+        window = range(6, self.__size - 5)
+        for enough in [5, 1]:
+            roomy = {c for c in range(components.count())
+                     if components.is_land(c) and components.size(c) >= enough}
+            spawn = components.pick(self.__prng, window, window, roomy)
+            if spawn:
+                return spawn
+        # A world without land, the player will need a Raft anyway.
+        return [self.__size // 2, self.__size // 2]
+
+    def get_components(self):
+        """ Returns the connected components of the island map, they are
+        only found the first time they are needed.
+        """
+        if self.__components is None:
+            self.__components = Components(self.__islandmap)
+        return self.__components
 
-    def scale_tiers(self):
-        """ Assigns each region of the world map with respective tiers.
+    def same_component(self, a, b):
+        """ Checks if two regions are connected by the same terrain.
         """
+        components = self.get_components()
+        return components.label(*a) == components.label(*b)
+
+    def reachable_without_raft(self, x, y):
+        """ Checks if a region can be walked to from the spawnpoint.
+        """
+        return not self.is_water(x, y) and self.same_component([x, y], self.spawnpoint)
+
+    def scale_tiers(self, xs, ys):
+        """ Assigns each region in the window of rows xs and columns ys
+        with its tier, from the Chebyshev distance to the spawnpoint.
+        """
+        scale = self.__tierscale
+        far = len(scale) - 1
         center = self.spawnpoint
-        tiermap = [[0 for _ in range(self.__size)] for _ in range(self.__size)]
-        for x in range(self.__size):
-            for y in range(self.__size):
-                if abs(x - center[0]) > 12 \
-                    or abs(y - center[1]) > 12:
-                    tiermap[x][y] = 3
-                elif abs(x - center[0]) > 8 \
-                    or abs(y - center[1]) > 8:
-                    tiermap[x][y] = 2
-                elif abs(x - center[0]) > 4 \
-                    or abs(y - center[1]) > 4:
-                    tiermap[x][y] = 1
-        return tiermap
+        # Distances are capped at far, so a row only ever needs one of
+        # far + 1 tables mapping a column distance to a tier.
+        tables = [bytes(scale[max(dx, dy)] for dy in range(far + 1)) + bytes(255 - far)
+                  for dx in range(far + 1)]
+        columns = bytes(min(abs(y - center[1]), far) for y in ys)
+        return tuple(columns.translate(tables[min(abs(x - center[0]), far)])
+                     for x in xs)
 
     def get_tiermap(self):
+        """ Returns the tier map as read-only rows of bytes.
+        """
         return self.__tiermap
 
-    def populate_biomes(self):
-        """ Assigns each region of the world map with respective biomes.
+    def get_tier(self, x, y):
+        return self.__tiermap[x][y]
+
+    def tier_at(self, x, y):
+        """ Computes the tier of a region without a tier map.
         """
-        biomemap = [[0 for _ in range(self.__size)] for _ in range(self.__size)]
-        for x in range(self.__size):
-            for y in range(self.__size):
-                if [x, y] == self.spawnpoint:
-                    biomemap[x][y] = SpawnRegion()
-                else:
-                    if self.__islandmap[x][y]:
-                        biomemap[x][y] = WaterRegion((self.__tiermap[x][y]))
-                    else:
-                        if self.__tiermap[x][y] == 0:
-                            biomemap[x][y] = GrasslandRegion()
-                        elif self.__tiermap[x][y] == 1:
-                            if x < self.__size / 2:
-                                biomemap[x][y] = PlateauRegion()
-                            else:
-                                biomemap[x][y] = ForestRegion()
-                        elif self.__tiermap[x][y] == 2:
-                            if x < self.__size / 2:
-                                biomemap[x][y] = MountainsRegion()
-                            else:
-                                biomemap[x][y] = JungleRegion()
-                        elif self.__tiermap[x][y] == 3:
-                            if x < self.__size / 2:
-                                biomemap[x][y] = SnowRegion()
-                            else:
-                                biomemap[x][y] = DesertRegion()
+        distance = max(abs(x - self.spawnpoint[0]), abs(y - self.spawnpoint[1]))
+        return self.__tierscale[min(distance, len(self.__tierscale) - 1)]
+
+    def is_water(self, x, y):
+        return bool(self.__islandmap[x][y])
+
+    def populate_biomes(self, island, tiers, xs, ys):
+        """ Assigns each region in the window of rows xs and columns ys
+        with its biome, stored as one byte of biome id per region.
+        island and tiers are the rows of that window.
+        """
+        water = bytes([0, 4]) + bytes(254)
+        # Indexed by tier, or by 4 + tier for water.
+        west = bytes([GRASSLAND, PLATEAU, MOUNTAINS, SNOW] + [WATER] * 4) + bytes(248)
+        east = bytes([GRASSLAND, FOREST, JUNGLE, DESERT] + [WATER] * 4) + bytes(248)
+        biomemap = []
+        for x, land, tier in zip(xs, island, tiers):
+            keys = bytes(map(add, land.translate(water), tier))
+            biomemap.append(bytearray(keys.translate(west if x < self.__size / 2 else east)))
+        sx, sy = self.spawnpoint
+        if sx in xs and sy in ys:
+            biomemap[sx - xs[0]][sy - ys[0]] = SPAWN
         return biomemap
 
+    def get_biome(self, x, y):
+        return self.__biomemap[x][y]
+
     def place_items(self):
         """ Randomly places all items into the world map.
         """
@@ -112,74 +260,616 @@ class GameWorld:
                      items.LemonJuice(),
                      items.BowArrow(),
                      items.CannedJellyfish()]
-        raft = items.Raft()
+        inner = range(3, self.__size - 2)
+        if self.generator < 2:
+            return self.place_items_v1(all_items, inner)
+        self.itemmap[items.Raft()] = self.spawnpoint
+        # Every item goes where the player can walk from the spawnpoint.
+        components = self.get_components()
+        home = components.label(*self.spawnpoint)
+        regions = components.sample(self.__prng, inner, inner, {home},
+                                    len(all_items) + 1)
+        regions = [r for r in regions if r != self.spawnpoint]
+        for item, region in zip(all_items, regions):
+            self.itemmap[item] = region
+        # Only on an island too small for every item.
+        for item in all_items[len(regions):]:
+            self.itemmap[item] = self.sample_free(inner, inner)
+        return self.itemmap
+
+    def place_items_v1(self, all_items, inner):
+        """ Places the items of a version 1 world, anywhere, drawing from
+        the Random in the same order as that version did.
+        """
         while True:
             x = self.__prng.randint(6, self.__size - 6)
             y = self.__prng.randint(6, self.__size - 6)
-            if not self.__islandmap[x][y] and self.__tiermap[x][y] == 0 \
+            if not self.is_water(x, y) and self.get_tier(x, y) == 0 \
                 and [x, y] != self.spawnpoint:
-                self.itemmap[raft] = self.spawnpoint
+                self.itemmap[items.Raft()] = self.spawnpoint
                 break
-        while len(all_items) > 0:
-            item = all_items.pop(0)
-            while True:
-                x = self.__prng.randint(3, self.__size - 3)
-                y = self.__prng.randint(3, self.__size - 3)
-                if [x, y] not in self.itemmap.values():
-                    self.itemmap[item] = [x, y]
-                    break
+        for item in all_items:
+            self.itemmap[item] = self.sample_free(inner, inner)
         return self.itemmap
 
+    def sample_free(self, xs, ys, tries=32, where=None):
+        """ Picks a random region within rows xs and columns ys that
+        has no item in it yet, and for which where(x, y) holds if given.
+        After a number of misses it picks from the suitable regions
+        directly, so it never loops for long.
+        """
+        def suitable(x, y):
+            return self.itemmap.is_free(x, y) and (where is None or where(x, y))
+        for _ in range(tries):
+            x = self.__prng.randint(xs[0], xs[-1])
+            y = self.__prng.randint(ys[0], ys[-1])
+            if suitable(x, y):
+                return [x, y]
+        free = [[x, y] for x in xs for y in ys if suitable(x, y)]
+        if not free:
+            raise ValueError("No free region left to place an item")
+        return self.__prng.choice(free)
+
     def get_region(self, x, y):
-        if any([x > len(self.__biomemap) - 1, x < 0,
-                y > len(self.__biomemap[0]) - 1, y < 0]):
+        """ Returns the shared Region of a cell, or None if out of bounds.
+        """
+        if any([x > self.__size - 1, x < 0,
+                y > self.__size - 1, y < 0]):
             return None
-        return self.__biomemap[x][y]
+        return REGIONS[self.get_biome(x, y)][self.get_tier(x, y)]
+
+    def render(self, layer="biome"):
+        """ Renders the island, tier or biome layer of the world map as a
+        palette of colours and one row of palette indices per x, with the
+        spawnpoint marked by the last colour.
+        """
+        if layer not in LAYER_COLORS:
+            raise ValueError(f"Unknown layer: {layer}")
+        palette = LAYER_COLORS[layer] + (SPAWN_COLOR,)
+        if layer == "island":
+            rows = [bytes(row) for row in self.__islandmap]
+        elif layer == "tier":
+            rows = [bytes(row) for row in self.__tiermap]
+        else:
+            rows = [bytes(row) for row in self.__biomemap]
+        sx, sy = self.spawnpoint
+        rows[sx] = rows[sx][:sy] + bytes([len(palette) - 1]) + rows[sx][sy + 1:]
+        return palette, rows
+
+    def to_array(self, layer="biome"):
+        """ Returns a layer as in render(), flattened into one bytes.
+        """
+        return b"".join(self.render(layer)[1])
+
+    def export_ppm(self, filename, layer="biome"):
+        """ Writes a layer of the world map as a binary PPM image.
+        """
+        write_ppm(filename, *self.render(layer))
+
+    def export_png(self, filename, layer="biome"):
+        """ Writes a layer of the world map as a PNG image.
+        """
+        write_png(filename, *self.render(layer))
 
     def ascii_map(self):
         """ Prints world map into the console for debugging purposes.
         """
-        for x in range(self.__size):
-            for y in range(self.__size):
-                if [x, y] == self.spawnpoint:
-                    print("X", end="")
-                else:
-                    if not self.__islandmap[x][y]:
-                        print("#", end="")
-                    else:
-                        print(".", end="")
-            print()
-        for x in range(self.__size):
-            for y in range(self.__size):
-                if [x, y] == self.spawnpoint:
-                    print("X", end="")
-                else:
-                    print(self.__tiermap[x][y], end="")
-            print()
-        for x in range(self.__size):
-            for y in range(self.__size):
-                if not self.__biomemap[x][y]:
-                    print(" ", end="")
-                else:
-                    if isinstance(self.__biomemap[x][y], SpawnRegion):
-                        print("*", end="")
-                    if isinstance(self.__biomemap[x][y], WaterRegion):
-                        print("~", end="")
-                    if isinstance(self.__biomemap[x][y], GrasslandRegion):
-                        print("G", end="")
-                    if isinstance(self.__biomemap[x][y], PlateauRegion):
-                        print("P", end="")
-                    if isinstance(self.__biomemap[x][y], ForestRegion):
-                        print("F", end="")
-                    if isinstance(self.__biomemap[x][y], MountainsRegion):
-                        print("M", end="")
-                    if isinstance(self.__biomemap[x][y], JungleRegion):
-                        print("J", end="")
-                    if isinstance(self.__biomemap[x][y], SnowRegion):
-                        print("S", end="")
-                    if isinstance(self.__biomemap[x][y], DesertRegion):
-                        print("D", end="")
-            print()
+        for layer, chars in [("island", "#.X"), ("tier", "0123X"),
+                             ("biome", "*~GPFMJSD*")]:
+            table = chars.encode("ascii") + bytes(256 - len(chars))
+            print("\n".join(row.translate(table).decode("ascii")
+                            for row in self.render(layer)[1]))
+
+class ChunkedGameWorld(GameWorld):
+    """ A GameWorld which generates the chunk around a region only when it
+    is first needed, so very large worlds start instantly.
+
+    The starting noise of every chunk comes from its own Random seeded by
+    the world seed and the chunk position. A chunk is simulated together
+    with a halo of its neighbours' noise as wide as the number of steps,
+    which keeps chunk edges the same as if the world was simulated whole.
+    Only max_chunks chunks are kept, the least recently used are evicted.
+    """
+    def __init__(self, seed="", size=10000, chunk_size=32, max_chunks=256,
+                 tiers=(4, 8, 12), generator=GENERATOR_VERSION):
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.__chunks = OrderedDict()
+        self.__components = ChunkComponents(self)
+        super().__init__(seed, "array", size, tiers, generator)
+
+    def generate(self):
+        """ Only decides the world-wide values, chunks come later.
+        """
+        self.__steps = self.get_prng().randint(3, 5)
+        self.spawnpoint = self.select_spawnpoint()
+        self.itemmap = self.place_items()
+
+    def make_noise(self, cx, cy):
+        """ Makes the starting noise of a chunk, it does not depend on
+        the order in which chunks are generated.
+        """
+        prng = Random(f"{self.seed}:{cx}:{cy}")
+        noise = []
+        for _ in range(self.chunk_size):
+            row = bytearray(self.chunk_size)
+            for y in range(self.chunk_size):
+                if prng.random() < 0.4:
+                    row[y] = 1
+            noise.append(row)
+        return noise
+
+    def gen_chunk(self, cx, cy):
+        """ Simulates the island map of a chunk.
+        """
+        size = self.chunk_size
+        halo = self.__steps
+        x0, y0 = cx * size, cy * size
+        x1, y1 = min(x0 + size, self.size), min(y0 + size, self.size)
+        wx0, wy0 = max(x0 - halo, 0), max(y0 - halo, 0)
+        wx1, wy1 = min(x1 + halo, self.size), min(y1 + halo, self.size)
+
+        noise = {}
+        for ncx in range(wx0 // size, (wx1 - 1) // size + 1):
+            for ncy in range(wy0 // size, (wy1 - 1) // size + 1):
+                noise[(ncx, ncy)] = self.make_noise(ncx, ncy)
+        window = []
+        for x in range(wx0, wx1):
+            row = bytearray()
+            for ncy in range(wy0 // size, (wy1 - 1) // size + 1):
+                part = noise[(x // size, ncy)][x % size]
+                start = max(wy0 - ncy * size, 0)
+                end = min(wy1 - ncy * size, size)
+                row += part[start:end]
+            window.append(row)
+        island = ChunkCellAutoIsland(window, halo).map
+        island = [row[y0 - wy0:y1 - wy0] for row in island[x0 - wx0:x1 - wx0]]
+        # Biomes need the spawnpoint, so get_region fills them in later.
+        chunk = [island, None]
+        self.__chunks[(cx, cy)] = chunk
+        while len(self.__chunks) > self.max_chunks:
+            self.__chunks.popitem(last=False)
+        return chunk
+
+    def get_chunk(self, x, y):
+        """ Returns the chunk holding a region, generating it if needed.
+        """
+        key = (x // self.chunk_size, y // self.chunk_size)
+        chunk = self.__chunks.get(key)
+        if chunk is None:
+            return self.gen_chunk(*key)
+        self.__chunks.move_to_end(key)
+        return chunk
+
+    def loaded_chunks(self):
+        return list(self.__chunks)
+
+    def is_water(self, x, y):
+        island, _ = self.get_chunk(x, y)
+        return bool(island[x % self.chunk_size][y % self.chunk_size])
+
+    def get_tier(self, x, y):
+        return self.tier_at(x, y)
+
+    def select_spawnpoint(self):
+        """ Chooses a land spawnpoint, looking at as few chunks as possible.
+        """
+        while True:
+            x = self.get_prng().randint(6, self.size - 6)
+            y = self.get_prng().randint(6, self.size - 6)
+            if not self.is_water(x, y):
+                return [x, y]
+
+    def get_components(self):
+        """ Returns the components of the world, which are found chunk by
+        chunk as they are asked about.
+        """
+        return self.__components
+
+    def same_component(self, a, b):
+        return self.__components.same(a, b)
+
+    def get_region(self, x, y):
+        if any([x > self.size - 1, x < 0,
+                y > self.size - 1, y < 0]):
+            return None
+        return REGIONS[self.get_biome(x, y)][self.get_tier(x, y)]
+
+    def get_biome(self, x, y):
+        chunk = self.get_chunk(x, y)
+        if chunk[1] is None:
+            x0 = x - x % self.chunk_size
+            y0 = y - y % self.chunk_size
+            xs = range(x0, x0 + len(chunk[0]))
+            ys = range(y0, y0 + len(chunk[0][0]))
+            chunk[1] = self.populate_biomes(chunk[0], self.scale_tiers(xs, ys), xs, ys)
+        return chunk[1][x % self.chunk_size][y % self.chunk_size]
+
+    def place_items(self):
+        """ Places all items around the spawnpoint where the player can
+        walk to, the whole world is too large to scatter them everywhere.
+        """
+        self.itemmap = {}
+        all_items = [items.InvincibilityPot(),
+                     items.LemonJuice(),
+                     items.BowArrow(),
+                     items.CannedJellyfish()]
+        self.itemmap[items.Raft()] = self.spawnpoint
+        xs, ys = [range(max(c - 12, 0), min(c + 13, self.size))
+                  for c in self.spawnpoint]
+        while len(all_items) > 0:
+            item = all_items.pop(0)
+            try:
+                region = self.sample_free(xs, ys, where=self.reachable_without_raft)
+            except ValueError:
+                # Only on an island too small for every item.
+                region = self.sample_free(xs, ys)
+            self.itemmap[item] = region
+        return self.itemmap
+
+class Components:
+    """ Connected components of land and of water in an island map.
+    Every row is split into runs of the same terrain with a regex and
+    touching runs of neighbouring rows are joined with a union-find,
+    then every cell gets the label of its component.
+    """
+    def __init__(self, island):
+        parent = []
+        rows = []
+        for x, row in enumerate(island):
+            runs = []
+            for match in re.finditer(rb"\x00+|\x01+", row):
+                start, end = match.span()
+                runs.append((start, end, row[start], len(parent)))
+                parent.append(len(parent))
+            if x > 0:
+                self.join(parent, rows[-1], runs)
+            rows.append(runs)
+
+        labels = {}
+        self.__sizes = []
+        self.__land = []
+        self.__runs = []
+        self.__labels = []
+        for runs in rows:
+            row = []
+            found = []
+            for start, end, water, run in runs:
+                root = self.find(parent, run)
+                if root not in labels:
+                    labels[root] = len(self.__sizes)
+                    self.__sizes.append(0)
+                    self.__land.append(not water)
+                label = labels[root]
+                self.__sizes[label] += end - start
+                row += [label] * (end - start)
+                found.append((start, end, label))
+            self.__labels.append(array("I", row))
+            self.__runs.append(found)
+
+    @staticmethod
+    def find(parent, run):
+        while parent[run] != run:
+            parent[run] = parent[parent[run]]
+            run = parent[run]
+        return run
+
+    def join(self, parent, above, below):
+        """ Joins the runs of two neighbouring rows which touch and
+        have the same terrain.
+        """
+        i = j = 0
+        while i < len(above) and j < len(below):
+            a, b = above[i], below[j]
+            if a[0] < b[1] and b[0] < a[1] and a[2] == b[2]:
+                parent[self.find(parent, a[3])] = self.find(parent, b[3])
+            if a[1] < b[1]:
+                i += 1
+            else:
+                j += 1
+
+    def label(self, x, y):
+        return self.__labels[x][y]
+
+    def size(self, label):
+        return self.__sizes[label]
+
+    def is_land(self, label):
+        return self.__land[label]
+
+    def count(self):
+        return len(self.__sizes)
+
+    def candidates(self, xs, ys, labels):
+        """ Lists the runs within rows xs and columns ys of the
+        components in labels, as (x, start, end).
+        """
+        low, high = ys[0], ys[-1] + 1
+        found = []
+        for x in xs:
+            for start, end, label in self.__runs[x]:
+                if label in labels and start < high and low < end:
+                    found.append((x, max(start, low), min(end, high)))
+        return found
+
+    def sample(self, prng, xs, ys, labels, k):
+        """ Picks up to k different regions, without retrying, from the
+        components in labels within rows xs and columns ys.
+        """
+        runs = self.candidates(xs, ys, labels)
+        total = sum(end - start for _, start, end in runs)
+        picks = sorted(prng.sample(range(total), min(k, total)))
+        regions = []
+        offset = 0
+        for x, start, end in runs:
+            while picks and picks[0] < offset + end - start:
+                regions.append([x, start + picks.pop(0) - offset])
+            offset += end - start
+        return regions
+
+    def pick(self, prng, xs, ys, labels):
+        """ Picks one region like sample(), or None if there is none.
+        """
+        regions = self.sample(prng, xs, ys, labels, 1)
+        return regions[0] if regions else None
+
+class ChunkComponents:
+    """ Connected components of a ChunkedGameWorld, found one chunk at a
+    time. Every chunk is labelled on its own by Components, and the
+    components of neighbouring chunks which touch across a chunk border
+    are joined with a union-find. A component is only followed through
+    up to reach chunks, regions joined further away count as apart.
+    """
+    def __init__(self, world, reach=16):
+        self.world = world
+        self.reach = reach
+        self.__local = OrderedDict()
+        self.__parent = {}
+        self.__closed = set()
+
+    def chunk(self, cx, cy):
+        """ Returns the Components of a chunk, keeping as many as the
+        world keeps chunks.
+        """
+        components = self.__local.get((cx, cy))
+        if components is not None:
+            self.__local.move_to_end((cx, cy))
+            return components
+        island, _ = self.world.get_chunk(cx * self.world.chunk_size,
+                                         cy * self.world.chunk_size)
+        components = Components(island)
+        self.__local[(cx, cy)] = components
+        while len(self.__local) > self.world.max_chunks:
+            self.__local.popitem(last=False)
+        return components
+
+    def key(self, x, y):
+        """ Returns the chunk and the label within it of a region.
+        """
+        size = self.world.chunk_size
+        cx, cy = x // size, y // size
+        return cx, cy, self.chunk(cx, cy).label(x % size, y % size)
+
+    def find(self, key):
+        parent = self.__parent
+        root = key
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while key != root:
+            parent[key], key = root, parent[key]
+        return root
+
+    def neighbours(self, key):
+        """ Lists the components of neighbouring chunks which touch the
+        component key across its chunk's border.
+        """
+        cx, cy, label = key
+        size = self.world.chunk_size
+        last = (self.world.size - 1) // size
+        here = self.chunk(cx, cy)
+        rows = min(size, self.world.size - cx * size)
+        cols = min(size, self.world.size - cy * size)
+        # The neighbouring chunk, and pairs of touching cells in both.
+        sides = []
+        if cx > 0:
+            sides.append((cx - 1, cy, [((0, y), (size - 1, y)) for y in range(cols)]))
+        if cx < last:
+            sides.append((cx + 1, cy, [((rows - 1, y), (0, y)) for y in range(cols)]))
+        if cy > 0:
+            sides.append((cx, cy - 1, [((x, 0), (x, size - 1)) for x in range(rows)]))
+        if cy < last:
+            sides.append((cx, cy + 1, [((x, cols - 1), (x, 0)) for x in range(rows)]))
+        land = here.is_land(label)
+        found = set()
+        for ncx, ncy, pairs in sides:
+            there = self.chunk(ncx, ncy)
+            for mine, theirs in pairs:
+                if here.label(*mine) != label:
+                    continue
+                other = there.label(*theirs)
+                if there.is_land(other) == land:
+                    found.add((ncx, ncy, other))
+        return found
+
+    def explore(self, start, goal=None):
+        """ Joins the component start with every component it touches,
+        until goal is joined to it or reach chunks were looked at.
+        """
+        if start in self.__closed:
+            return
+        seen = {start}
+        chunks = {start[:2]}
+        queue = [start]
+        while queue:
+            key = queue.pop()
+            for other in self.neighbours(key):
+                if other in seen:
+                    continue
+                if other[:2] not in chunks:
+                    if len(chunks) == self.reach:
+                        return
+                    chunks.add(other[:2])
+                seen.add(other)
+                self.__parent[self.find(other)] = self.find(start)
+                if goal is not None and self.find(goal) == self.find(start):
+                    return
+                queue.append(other)
+        # Every part of the component is known now.
+        self.__closed |= seen
+
+    def label(self, x, y):
+        key = self.key(x, y)
+        self.explore(key)
+        return self.find(key)
+
+    def same(self, a, b):
+        """ Checks if two regions are connected by the same terrain.
+        """
+        start, goal = self.key(*a), self.key(*b)
+        if self.find(start) != self.find(goal):
+            self.explore(start, goal)
+        return self.find(start) == self.find(goal)
+
+def write_ppm(filename, palette, rows):
+    """ Writes rows of palette indices as a binary (P6) PPM image.
+    """
+    colors = [bytes.fromhex(color[1:]) for color in palette]
+    with open(filename, "wb") as f:
+        f.write(f"P6 {len(rows[0])} {len(rows)} 255\n".encode("ascii"))
+        f.write(b"".join(b"".join(map(colors.__getitem__, row)) for row in rows))
+
+def write_png(filename, palette, rows):
+    """ Writes rows of palette indices as an indexed colour PNG image.
+    """
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data \
+            + struct.pack(">I", zlib.crc32(kind + data))
+    header = struct.pack(">IIBBBBB", len(rows[0]), len(rows), 8, 3, 0, 0, 0)
+    colors = b"".join(bytes.fromhex(color[1:]) for color in palette)
+    # Every scanline starts with filter type 0.
+    pixels = zlib.compress(b"".join(b"\x00" + row for row in rows))
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+                + chunk(b"PLTE", colors) + chunk(b"IDAT", pixels)
+                + chunk(b"IEND", b""))
+
+class ItemMap(dict):
+    """ Maps every item of a world to the region it lies in, or to 0
+    once it has been picked up. An index from region to items is kept
+    in sync, so finding the items of a region needs no scan.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.__regions = {}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, item, region):
+        if item in self:
+            self.__unindex(item)
+        super().__setitem__(item, region)
+        if region:
+            self.__regions.setdefault((region[0], region[1]), []).append(item)
+
+    def __delitem__(self, item):
+        self.__unindex(item)
+        super().__delitem__(item)
+
+    def __unindex(self, item):
+        region = self[item]
+        if not region:
+            return
+        key = (region[0], region[1])
+        self.__regions[key].remove(item)
+        if not self.__regions[key]:
+            del self.__regions[key]
+
+    def update(self, *args, **kwargs):
+        for item, region in dict(*args, **kwargs).items():
+            self[item] = region
+
+    def setdefault(self, item, region=None):
+        if item not in self:
+            self[item] = region
+        return self[item]
+
+    def pop(self, item, *default):
+        if item not in self:
+            return super().pop(item, *default)
+        self.__unindex(item)
+        return super().pop(item)
+
+    def popitem(self):
+        item, region = super().popitem()
+        super().__setitem__(item, region)
+        del self[item]
+        return item, region
+
+    def clear(self):
+        super().clear()
+        self.__regions.clear()
+
+    def at(self, x, y):
+        """ Returns the items lying in a region.
+        """
+        return list(self.__regions.get((x, y), ()))
+
+    def is_free(self, x, y):
+        return (x, y) not in self.__regions
+
+class RegionCache:
+    """ Keeps the packed state of the regions the player has left, so a
+    region looks the same when it is entered again. States are bytes
+    kept most recently used last, and the least recently used ones are
+    dropped once all of them take more than max_bytes.
+    """
+    # A region in the state of a version 1 or older save.
+    entry = struct.Struct("<BBH")
+
+    def __init__(self, max_bytes=65536):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.__states = OrderedDict()
+
+    def __len__(self):
+        return len(self.__states)
+
+    def __contains__(self, region):
+        return tuple(region) in self.__states
+
+    def put(self, x, y, state):
+        self.take(x, y)
+        self.__states[(x, y)] = state
+        self.nbytes += len(state)
+        while self.nbytes > self.max_bytes and len(self.__states) > 1:
+            _, dropped = self.__states.popitem(last=False)
+            self.nbytes -= len(dropped)
+
+    def take(self, x, y):
+        """ Removes and returns the state of a region, or None.
+        """
+        state = self.__states.pop((x, y), None)
+        if state is not None:
+            self.nbytes -= len(state)
+        return state
+
+    def states(self):
+        """ Returns (region, state) pairs, least recently used first.
+        """
+        return list(self.__states.items())
+
+    def from_bytes(self, data):
+        """ Puts the states of a version 1 or older save, which packed
+        them as a count and then x, y, length and state per region.
+        Returns the bytes read. Newer saves list the states themselves.
+        """
+        count, = struct.unpack_from("<H", data)
+        offset = 2
+        for _ in range(count):
+            x, y, length = self.entry.unpack_from(data, offset)
+            offset += self.entry.size
+            self.put(x, y, bytes(data[offset:offset + length]))
+            offset += length
+        return offset
 
 class CellAutoIsland:
     """ An implementation of Cellular Automata to generate
@@ -237,95 +927,172 @@ class CellAutoIsland:
     def make_map(self, steps):
         result = self.make_grid()
         result = self.make_chunks(result)
+        return self.evolve(result, steps)
+
+    def evolve(self, grid, steps):
         for _ in range(steps):
-            result = self.simulate(result, 3, 4)
-        return result
+            grid = self.simulate(grid, 3, 4)
+        return grid
+
+class ArrayCellAutoIsland(CellAutoIsland):
+    """ Array-backed version of CellAutoIsland which gives the same map
+    for the same Random stream. Every row is a bytearray, and a row is
+    packed into one integer with a byte per cell so the neighbours of
+    the whole row are summed with a few shifts and additions.
+    """
+    def make_grid(self):
+        return [bytearray(self._width) for _ in range(self._height)]
+
+    def rule_table(self, death, birth):
+        """ Maps (neighbours * 2 + alive) to the next state of a cell.
+        """
+        table = bytearray(256)
+        for nbs in range(9):
+            table[nbs * 2 + 1] = 1 if nbs >= death else 0
+            table[nbs * 2] = 1 if nbs > birth else 0
+        return bytes(table)
+
+    def simulate(self, orig, death, birth):
+        width = len(orig[0]) + 2
+        mask = (1 << (8 * width)) - 1
+        table = self.rule_table(death, birth)
+        # Out of bounds counts as alive, so the grid is padded with 1s.
+        edge = int.from_bytes(b"\x01" * width, "big")
+        rows = [edge]
+        for row in orig:
+            rows.append(int.from_bytes(b"\x01" + bytes(row) + b"\x01", "big"))
+        rows.append(edge)
+        # Every byte holds the sum of itself and its left and right cells.
+        triples = [r + (r << 8) + (r >> 8) for r in rows]
+        dest = []
+        for i in range(1, len(rows) - 1):
+            block = triples[i - 1] + triples[i] + triples[i + 1]
+            # 2 * (block - cell) + cell, i.e. neighbours * 2 + alive.
+            key = (2 * block - rows[i]) & mask
+            dest.append(bytearray(key.to_bytes(width, "big")[1:-1].translate(table)))
+        return dest
+
+class ChunkCellAutoIsland(ArrayCellAutoIsland):
+    """ Simulates a window of a larger world from already made noise,
+    instead of drawing the noise from a Random stream.
+    """
+    def __init__(self, noise, steps):
+        self._width = len(noise[0]) if noise else 0
+        self._height = len(noise)
+        self.map = self.evolve(noise, steps)
 
 class Region:
     """ An abstract class of Region to contain tier and type.
+    Regions are immutable, every world shares the instances in REGIONS.
     """
+    __slots__ = ("__rtype", "__tier")
+    biome_id = None
+
     def __init__(self, rtype, tier):
-        self.rtype = rtype
-        self.tier = tier
+        if not isinstance(tier, int):
+            raise TypeError("tier must be integer")
+        self.__rtype = rtype
+        self.__tier = tier
 
     @property
     def rtype(self):
         return self.__rtype
 
-    @rtype.setter
-    def rtype(self, rtype):
-        self.__rtype = rtype
-
     @property
     def tier(self):
         return self.__tier
 
-    @tier.setter
-    def tier(self, tier):
-        if not isinstance(tier, int):
-            raise TypeError("tier must be integer")
-        self.__tier = tier
-
     def populate(self, screen):
         pass
 
 class LandRegion(Region):
     """ Land where the Player can move freely.
     """
+    __slots__ = ("__biome",)
+
     def __init__(self, tier, biome=""):
         super().__init__("land", tier)
-        self.biome = biome
+        self.__biome = biome
 
     @property
     def biome(self):
         return self.__biome
 
-    @biome.setter
-    def biome(self, biome):
-        self.__biome = biome
-
 class WaterRegion(Region):
     """ Water where Player is required to have a Raft before crossing.
     """
+    __slots__ = ()
+    biome_id = WATER
+
     def __init__(self, tier):
         super().__init__("water", tier)
 
 class SpawnRegion(LandRegion):
+    __slots__ = ()
+    biome_id = SPAWN
 
     def __init__(self):
         super().__init__(0, "spawn")
 
 class GrasslandRegion(LandRegion):
+    __slots__ = ()
+    biome_id = GRASSLAND
 
     def __init__(self):
         super().__init__(0, "grassland")
 
 class ForestRegion(LandRegion):
+    __slots__ = ()
+    biome_id = FOREST
 
     def __init__(self):
         super().__init__(1, "forest")
 
 class PlateauRegion(LandRegion):
+    __slots__ = ()
+    biome_id = PLATEAU
 
     def __init__(self):
         super().__init__(1, "plateau")
 
 class JungleRegion(LandRegion):
+    __slots__ = ()
+    biome_id = JUNGLE
 
     def __init__(self):
         super().__init__(2, "jungle")
 
 class MountainsRegion(LandRegion):
+    __slots__ = ()
+    biome_id = MOUNTAINS
 
     def __init__(self):
         super().__init__(2, "mountains")
 
 class DesertRegion(LandRegion):
+    __slots__ = ()
+    biome_id = DESERT
 
     def __init__(self):
         super().__init__(3, "desert")
 
 class SnowRegion(LandRegion):
+    __slots__ = ()
+    biome_id = SNOW
 
     def __init__(self):
         super().__init__(3, "snow")
+
+def make_regions():
+    """ Creates the shared Regions, indexed by biome id and then tier.
+    Land biomes have a fixed tier, so the same Region fills every tier.
+    """
+    regions = [None] * 9
+    for cls in [SpawnRegion, GrasslandRegion, PlateauRegion, ForestRegion,
+                MountainsRegion, JungleRegion, SnowRegion, DesertRegion]:
+        region = cls()
+        regions[cls.biome_id] = (region,) * 4
+    regions[WATER] = tuple(WaterRegion(tier) for tier in range(4))
+    return tuple(regions)
+
+REGIONS = make_regions()
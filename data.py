@@ -1,90 +1,475 @@
 from datetime import datetime as dt
+from collections import OrderedDict
+from hashlib import sha1
+from contextlib import contextmanager
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+try:
+    import fcntl
+except ImportError:
+    # Windows locks files through msvcrt instead.
+    fcntl = None
+    import msvcrt
+from queue import Queue
+from threading import Thread
 import entities as ent
 import cartography as car
 import items as its
 
+log = logging.getLogger(__name__)
+
+class WorldCache:
+    """ Keeps generated worlds in memory and in ".world" files on disk,
+    keyed by seed, size, tiers and generator version, so a world is only
+    generated again on a cache miss or when the generator changes.
+
+    A ".world" file is a header, the seed, the item placements, the
+    state of the world's Random and then the island, tier and biome maps
+    as raw bytes, so they are read by memory-mapping the file. Only the
+    max_files most recently used files are kept, the directory can also
+    be deleted at any time.
+    """
+    magic = b"TLOW"
+    header = struct.Struct("<4sHIII3BBH")
+    placement = struct.Struct("<2sII")
+    prng = struct.Struct("<625I")
+
+    def __init__(self, directory=".worldcache", capacity=8, max_files=32):
+        self.directory = directory
+        self.capacity = capacity
+        self.max_files = max_files
+        self.__worlds = OrderedDict()
+
+    def path(self, seed, size, tiers, generator):
+        key = sha1(f"{seed}:{tiers}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{key}-{size}-v{generator}.world")
+
+    def load(self, seed, size=24, tiers=(4, 8, 12), generator=car.GENERATOR_VERSION,
+             chunk_size=0):
+        """ Returns the world of a seed, generating it only if it is
+        neither in memory nor on disk. With a chunk_size it is a
+        ChunkedGameWorld, which is never cached as it starts at once.
+        """
+        if chunk_size:
+            return car.ChunkedGameWorld(seed, size, chunk_size, tiers=tiers,
+                                        generator=generator)
+        key = (seed, size, tuple(tiers), generator)
+        template = self.__worlds.get(key)
+        if template is not None:
+            self.__worlds.move_to_end(key)
+        else:
+            template = self.read(*key)
+            if template is None:
+                world = car.GameWorld(seed, size=size, tiers=tiers,
+                                      generator=generator)
+                self.store(world)
+                return world
+            self.remember(template)
+        seed, generator, tiers, spawn, layers, placements, state = template
+        itemmap = {its.make_item(key): list(region) for key, region in placements}
+        return car.GameWorld.from_layers(seed, tiers, spawn, layers, itemmap,
+                                         state, generator)
+
+    def store(self, world):
+        """ Caches a freshly generated world, before anything changed it.
+        """
+        placements = [(i.key, tuple(region)) for i, region in world.itemmap.items()
+                      if region != 0]
+        template = (world.seed, world.generator, world.tiers,
+                    tuple(world.spawnpoint), world.get_layers(), placements,
+                    world.get_prng().getstate())
+        self.remember(template)
+        try:
+            self.write(template)
+        except OSError:
+            # The disk cache is only an optimization.
+            pass
+
+    def remember(self, template):
+        seed, generator, tiers, _, layers = template[:5]
+        key = (seed, len(layers[0]), tuple(tiers), generator)
+        self.__worlds[key] = template
+        while len(self.__worlds) > self.capacity:
+            self.__worlds.popitem(last=False)
+
+    def write(self, template):
+        seed, generator, tiers, spawn, layers, placements, state = template
+        size = len(layers[0])
+        bseed = seed.encode("utf-8")
+        version, internal, gauss = state
+        if version != 3 or gauss is not None:
+            return
+        buf = bytearray(self.header.pack(self.magic, generator,
+                                         size, spawn[0], spawn[1], *tiers,
+                                         len(placements), len(bseed)))
+        buf += bseed
+        for key, region in placements:
+            buf += self.placement.pack(key.encode("ascii"), *region)
+        buf += self.prng.pack(*internal)
+        for layer in layers:
+            for row in layer:
+                buf += row
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(seed, size, tiers, generator)
+        with open(path + ".tmp", "wb") as f:
+            f.write(buf)
+        os.replace(path + ".tmp", path)
+        self.prune()
+
+    def prune(self):
+        """ Deletes the least recently used ".world" files beyond
+        max_files, a file is used when it is written or read.
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".world"):
+                path = os.path.join(self.directory, name)
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+        files.sort()
+        for _, path in files[:max(0, len(files) - self.max_files)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def read(self, seed, size, tiers, generator):
+        """ Maps a ".world" file, returns None if it is missing or stale.
+        """
+        path = self.path(seed, size, tiers, generator)
+        try:
+            with open(path, "rb") as f:
+                view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            # Marks the file as used, so prune() keeps it longer.
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if len(view) < self.header.size:
+            return None
+        magic, version, stored, sx, sy, t1, t2, t3, count, seedlen = \
+            self.header.unpack_from(view)
+        if magic != self.magic or version != generator or stored != size \
+                or (t1, t2, t3) != tuple(tiers):
+            return None
+        offset = self.header.size
+        if bytes(view[offset:offset + seedlen]).decode("utf-8") != f"{seed}":
+            return None
+        offset += seedlen
+        placements = []
+        for _ in range(count):
+            key, x, y = self.placement.unpack_from(view, offset)
+            placements.append((key.decode("ascii"), (x, y)))
+            offset += self.placement.size
+        state = (3, self.prng.unpack_from(view, offset), None)
+        offset += self.prng.size
+        if len(view) != offset + 3 * size * size:
+            return None
+        layers = []
+        for _ in range(3):
+            layers.append(tuple(view[offset + x * size:offset + (x + 1) * size]
+                                for x in range(size)))
+            offset += size * size
+        return (seed, generator, (t1, t2, t3), (sx, sy), tuple(layers),
+                placements, state)
+
+world_cache = WorldCache()
+
+def put_varint(buf, value):
+    """ Appends an unsigned integer in 7 bit groups, low group first,
+    with the high bit set on every byte but the last.
+    """
+    while value > 0x7F:
+        buf.append(value & 0x7F | 0x80)
+        value >>= 7
+    buf.append(value)
+
+def get_varint(view, offset):
+    """ Reads an integer written by put_varint(), returns it and the
+    offset after it.
+    """
+    value = shift = 0
+    while True:
+        if offset >= len(view):
+            raise IOError("Save file is truncated")
+        byte = view[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def put_bytes(buf, data):
+    put_varint(buf, len(data))
+    buf += data
+
+def get_bytes(view, offset):
+    size, offset = get_varint(view, offset)
+    if offset + size > len(view):
+        raise IOError("Save file is truncated")
+    return bytes(view[offset:offset + size]), offset + size
+
 class GameData:
-    """ A class to save/load game data as a custom 79~ bytes file.
+    """ A class to save/load game data. A save is a header, a record of
+    the player and the world's items, the state of visited regions and
+    a CRC32 of it all, see saveformat.txt. Numbers are varints, so any
+    world size or score fits. Saves of version 1 and of the older hex
+    format still load.
     """
-    def __init__(self, filename="game.save"):
+    VERSION = 2
+    ITEM_KEYS = ("A0", "A1", "A2", "A3", "FF")
+    # Size, tiers, generator version and chunk size of the worlds of
+    # version 1 saves.
+    V1_WORLD = (24, (4, 8, 12), 2, 0)
+    head = struct.Struct("<4sB")
+    body = struct.Struct("<Q20s16sBBIBB4s15s")
+    length = struct.Struct("<I")
+
+    def __init__(self, filename="game.save", cache=world_cache):
         self.filename = filename
+        self.cache = cache
         self.magic = b"\x01\x4b\x55\x02"
         self.sep = b"\x5c"
 
     def save(self, player, world):
-        """ Saving function.
-        """
-        with open(self.filename, "wb") as f:
-            f.write(self.magic)
-            dtnow = dt.now()
-            dtstring = dtnow.strftime("%Y%m%d%H%M%S")
-            f.write(bytes.fromhex(dtstring))
-            seed = ''.join(hex(ord(x))[2:] for x in world.seed)
-            f.write(bytes.fromhex(seed))
-            f.write(self.sep)
-
-            name = ''.join(hex(ord(x))[2:] for x in player.name)
-            bname = bytes.fromhex(name)
-            if len(bname) < 16:
-                bname += b'\x00' * (16 - len(bname))
-            f.write(bname)
-            x = str(player.region[0])
-            y = str(player.region[1])
-            f.write(bytes.fromhex("0" + x if len(x) <= 1 else x))
-            f.write(bytes.fromhex("0" + y if len(y) <= 1 else y))
-            score = str(player.score)[::-1]
-            ns = ""
-            if len(score) < 5:
-                score += '0' * (5 - len(score))
-            for i in score:
-                i = "0" + i
-                ns += i
-            bscore = bytes.fromhex(ns)
-            f.write(bscore)
-            f.write(bytes.fromhex("0" + str(player.tier)))
-            f.write(self.sep)
-
-            if player.can_swim:
-                swim = b'\xff'
-            else:
-                swim = b'\x00'
-            f.write(swim)
-            f.write(self.sep)
-
-            items = ""
-            for i in player.inventory.active:
-                items += i.key
-            bitems = bytes.fromhex(items)
-            if len(bitems) < 4:
-                bitems += b'\x00' * (4 - len(bitems))
-            f.write(bitems)
-            f.write(self.sep)
-
-            items = ""
-            for i in world.itemmap:
-                if world.itemmap[i] != 0:
-                    item = i
-                    region = world.itemmap[i]
-                    x = str(region[0])
-                    y = str(region[1])
-                    if len(x) < 2:
-                        x = "0" + x
-                    if len(y) < 2:
-                        y = "0" + y
-                    f.write(bytes.fromhex(x))
-                    f.write(bytes.fromhex(y))
-                    f.write(bytes.fromhex(item.key))
+        """ Saving function. The save is packed into one buffer, written
+        to a temporary file and then renamed over the old save, so a
+        crash while saving never leaves a broken save behind.
+        """
+        buf = self.pack(player, world)
+        with open(self.filename + ".tmp", "wb") as f:
+            f.write(buf)
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def pack(self, player, world, limit=None):
+        """ Packs a save into one buffer. If it would be longer than
+        limit, the least recently used regions are left out of the
+        region state until it fits, the region of the player last.
+        """
+        buf = bytearray(self.head.pack(self.magic, self.VERSION))
+        buf += self.record(player, world)
+        current = tuple(player.region)
+        entries = []
+        for (x, y), state in world.regions.states():
+            entry = bytearray()
+            put_varint(entry, x)
+            put_varint(entry, y)
+            put_bytes(entry, state)
+            entries.append(((x, y), entry))
+        if limit:
+            # Stable, so the rest stay least recently used first.
+            entries.sort(key=lambda e: e[0] == current)
+            size = len(buf) + sum(len(e) for _, e in entries) + self.length.size
+            while entries:
+                count = bytearray()
+                put_varint(count, len(entries))
+                if size + len(count) <= limit:
+                    break
+                size -= len(entries.pop(0)[1])
+        put_varint(buf, len(entries))
+        for _, entry in entries:
+            buf += entry
+        buf += self.length.pack(zlib.crc32(buf))
+        return buf
+
+    def record(self, player, world):
+        """ Packs the player and the items still lying in the world.
+        """
+        buf = bytearray()
+        put_varint(buf, int(dt.now().timestamp()))
+        put_bytes(buf, f"{world.seed}".encode("ascii"))
+        put_varint(buf, world.size)
+        for tier in world.tiers:
+            put_varint(buf, tier)
+        put_varint(buf, world.generator)
+        chunked = isinstance(world, car.ChunkedGameWorld)
+        put_varint(buf, world.chunk_size if chunked else 0)
+        put_bytes(buf, player.name.encode("ascii"))
+        put_varint(buf, player.region[0])
+        put_varint(buf, player.region[1])
+        put_varint(buf, player.score)
+        buf.append(player.tier)
+        buf.append(0xFF if player.can_swim else 0x00)
+        put_bytes(buf, bytes(int(i.key, 16) for i in player.inventory.active))
+        placed = [(i, r) for i, r in world.itemmap.items() if r != 0]
+        put_varint(buf, len(placed))
+        for item, region in placed:
+            buf.append(int(item.key, 16))
+            put_varint(buf, region[0])
+            put_varint(buf, region[1])
+        effects = [(i, i.remaining()) for i in player.inventory.active
+                   if i.remaining()]
+        put_varint(buf, len(effects))
+        for item, ticks in effects:
+            buf.append(int(item.key, 16))
+            put_varint(buf, ticks)
+        return buf
+
+    def read_record(self, view, offset):
+        """ Reads a record packed by record(), returns its values and the
+        offset after it.
+        """
+        saved_at, offset = get_varint(view, offset)
+        seed, offset = get_bytes(view, offset)
+        size, offset = get_varint(view, offset)
+        tiers = []
+        for _ in range(3):
+            tier, offset = get_varint(view, offset)
+            tiers.append(tier)
+        generator, offset = get_varint(view, offset)
+        chunk_size, offset = get_varint(view, offset)
+        name, offset = get_bytes(view, offset)
+        x, offset = get_varint(view, offset)
+        y, offset = get_varint(view, offset)
+        score, offset = get_varint(view, offset)
+        if offset + 2 > len(view):
+            raise IOError("Save file is truncated")
+        tier, swim = view[offset], view[offset + 1]
+        active, offset = get_bytes(view, offset + 2)
+        count, offset = get_varint(view, offset)
+        placed = []
+        for _ in range(count):
+            if offset >= len(view):
+                raise IOError("Save file is truncated")
+            code = view[offset]
+            ix, offset = get_varint(view, offset + 1)
+            iy, offset = get_varint(view, offset)
+            placed.append((code, ix, iy))
+        count, offset = get_varint(view, offset)
+        effects = []
+        for _ in range(count):
+            if offset >= len(view):
+                raise IOError("Save file is truncated")
+            code = view[offset]
+            ticks, offset = get_varint(view, offset + 1)
+            effects.append((code, ticks))
+        fields = (saved_at, seed, name, x, y, score, tier, swim, active,
+                  placed, effects, (size, tuple(tiers), generator, chunk_size))
+        return fields, offset
+
+    def intact(self, data):
+        """ Checks the CRC32 at the end of a packed save.
+        """
+        if len(data) < self.head.size + self.length.size:
+            return False
+        crc, = self.length.unpack_from(data, len(data) - self.length.size)
+        return crc == zlib.crc32(data[:len(data) - self.length.size])
 
     def load(self):
         """ Loading function. Returns Player and GameWorld.
         """
+        with open(self.filename, "rb") as f:
+            data = f.read()
+        # Older saves have the year in BCD at byte 4, always 0x20.
+        if data[:4] == self.magic and data[4:5] == b"\x20":
+            return self.load_legacy()
+        return self.unpack(data)
+
+    def unpack(self, data):
+        """ Unpacks a save packed by pack(), or of version 1.
+        Returns Player and GameWorld.
+        """
+        view = memoryview(data)
+        if len(view) < self.head.size or bytes(view[:4]) != self.magic:
+            raise IOError("File is not a save file")
+        version = view[4]
+        if version > self.VERSION:
+            raise IOError(f"Save version {version} is newer than this game")
+        if len(view) < self.head.size + 2 * self.length.size:
+            raise IOError("Save file is truncated")
+        crc, = self.length.unpack_from(view, len(view) - self.length.size)
+        view = view[:len(view) - self.length.size]
+        if crc != zlib.crc32(view):
+            raise IOError("Save file is corrupted")
+        if version == 1:
+            return self.unpack_v1(view)
+
+        fields, offset = self.read_record(view, self.head.size)
+        player, wld = self.build(fields)
+        count, offset = get_varint(view, offset)
+        for _ in range(count):
+            x, offset = get_varint(view, offset)
+            y, offset = get_varint(view, offset)
+            state, offset = get_bytes(view, offset)
+            wld.regions.put(x, y, state)
+        return player, wld
+
+    def unpack_v1(self, view):
+        """ Unpacks the fixed struct layout of version 1 saves.
+        """
+        if len(view) < self.head.size + self.body.size + self.length.size:
+            raise IOError("Save file is truncated")
+        fields = self.body.unpack_from(view, self.head.size)
+        saved_at, seed, name, x, y, score, tier, swim, active, placed = fields
+        placed = [tuple(placed[slot:slot + 3]) for slot in range(0, 15, 3)
+                  if placed[slot]]
+        player, wld = self.build((saved_at, seed.rstrip(b"\x00"),
+                                  name.rstrip(b"\x00"), x, y, score, tier,
+                                  swim, active.rstrip(b"\x00"), placed, [],
+                                  self.V1_WORLD))
+        offset = self.head.size + self.body.size
+        size, = self.length.unpack_from(view, offset)
+        offset += self.length.size
+        if size:
+            wld.regions.from_bytes(view[offset:offset + size])
+        return player, wld
+
+    def build(self, fields):
+        """ Makes the Player and GameWorld of the values of a record.
+        """
+        (saved_at, seed, name, x, y, score, tier, swim, active, placed,
+         effects, world) = fields
+        items = {key: its.make_item(key) for key in self.ITEM_KEYS}
+        try:
+            wld = self.cache.load(seed.decode("ascii"), *world)
+        except (TypeError, ValueError) as e:
+            raise IOError(f"Unknown world: {e}")
+        wld.itemmap = {item: 0 for item in items.values()}
+
+        player = ent.Player(name.decode("ascii"), wld)
+        player.saved_at = saved_at
+        if x >= wld.size or y >= wld.size:
+            raise IOError(f"Unknown position: {x}, {y}")
+        player.region = [x, y]
+        player.score = score
+        if tier > 3:
+            raise IOError(f"Unknown tier: {tier}")
+        player.tier = tier
+        if swim not in (0x00, 0xFF):
+            raise IOError(f"Unknown bool operation: {swim}")
+        player.can_swim = swim == 0xFF
+        if player.can_swim:
+            player.inventory.add(items["FF"])
+        for code in active:
+            player.inventory.add(self.item(items, code))
+        for code, ix, iy in placed:
+            wld.itemmap[self.item(items, code)] = [ix, iy]
+        for code, ticks in effects:
+            player.effects[self.item(items, code).key] = ticks
+        return player, wld
+
+    def item(self, items, code):
+        key = f"{code:02X}"
+        if key not in items:
+            raise IOError(f"Unknown item code: {key}")
+        return items[key]
+
+    def load_legacy(self):
+        """ Loads a save of the older hex format.
+        """
         with open(self.filename, "rb") as f:
             if f.read(4) != self.magic:
                 raise IOError("File is not a save file")
             f.seek(7, 1)
             seed = f.read(20)
 
-            wld = car.GameWorld(seed.decode("ascii"))
+            # Saves of this format were made with worlds of version 1.
+            wld = self.cache.load(seed.decode("ascii"), generator=1)
             wld.itemmap = {}
             IP = its.InvincibilityPot()
             LJ = its.LemonJuice()
@@ -162,6 +547,9 @@ class GameData:
             
             while True:
                 item = f.read(3)
+                if item[:1] == self.sep:
+                    wld.regions.from_bytes(item[1:] + f.read())
+                    break
                 struct = [item[i:i+1] for i in range(len(item))]
                 if "" in struct or len(struct) != 3:
                     break
@@ -179,4 +567,400 @@ class GameData:
                 if key == b'\xFF':
                     wld.itemmap[RAFT] = [x, y]
 
-        return player, wld
\ No newline at end of file
+        return player, wld
+
+class SaveArchive:
+    """ Keeps the saves of many players in one memory-mapped file, in
+    fixed-size slots found by player name. The file starts with a header
+    and an index of the name in every slot, so a save is loaded or
+    written in place without opening other files.
+
+    Every slot holds two copies of a save, each with a generation. A
+    save never overwrites the copy which would load now, and raises the
+    generation only once it is written, so a crash while saving leaves
+    the other copy to load. Writers take
+    a lock on a ".lock" file next to the archive and read the index
+    entries of new slots under it, so several games can share one archive.
+    A save which does not fit its copy leaves out the state of the least
+    recently used regions until it fits, the region of the player last.
+    """
+    magic = b"TLOA"
+    VERSION = 1
+    header = struct.Struct("<4sBHII")
+    entry = struct.Struct("<16s")
+    copy = struct.Struct("<IH")
+
+    def __init__(self, filename="game.saves", slot_size=1024, capacity=64,
+                 cache=world_cache):
+        self.filename = filename
+        self.slot_size = slot_size
+        self.capacity = capacity
+        self.codec = GameData(cache=cache)
+        self.__lock = None
+        self.__file = None
+        self.__map = None
+        self.__index = None
+
+    @contextmanager
+    def locked(self):
+        """ Holds the lock of the archive, with the map and index up to
+        date with the file.
+        """
+        if self.__lock is None:
+            self.__lock = open(self.filename + ".lock", "a+b")
+        if fcntl:
+            fcntl.flock(self.__lock.fileno(), fcntl.LOCK_EX)
+        else:
+            self.__lock.seek(0)
+            msvcrt.locking(self.__lock.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            self.refresh()
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(self.__lock.fileno(), fcntl.LOCK_UN)
+            else:
+                self.__lock.seek(0)
+                msvcrt.locking(self.__lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def refresh(self):
+        """ Maps the archive again if another game has rewritten it, and
+        reads the index entries of slots other games have taken since.
+        """
+        if self.__map is not None:
+            try:
+                same = os.path.samestat(os.stat(self.filename),
+                                        os.fstat(self.__file.fileno()))
+            except OSError:
+                same = False
+            if not same:
+                self.unmap()
+        if self.__map is None:
+            self.open()
+        else:
+            self.read_index()
+
+    def open(self):
+        """ Maps the archive, making an empty one if there is none yet.
+        """
+        if self.__map is not None:
+            return
+        if not os.path.exists(self.filename):
+            self.create(self.filename, self.slot_size, self.capacity, [])
+        self.__file = open(self.filename, "r+b")
+        self.__map = mmap.mmap(self.__file.fileno(), 0)
+        magic, version, slot_size, capacity, _ = \
+            self.header.unpack_from(self.__map)
+        if magic != self.magic or version != self.VERSION:
+            self.unmap()
+            raise IOError("File is not a save archive")
+        self.slot_size = slot_size
+        self.capacity = capacity
+        self.read_index()
+
+    def read_index(self):
+        """ Reads the names of the slots taken since the index was last
+        read, as slots are only ever added at the end.
+        """
+        count = self.header.unpack_from(self.__map)[4]
+        if self.__index is None:
+            self.__index = {}
+        for slot in range(len(self.__index), count):
+            name, = self.entry.unpack_from(self.__map, self.header.size
+                                           + slot * self.entry.size)
+            self.__index[name.rstrip(b"\x00").decode("ascii")] = slot
+
+    def unmap(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__file.close()
+        self.__file = None
+        self.__map = None
+        self.__index = None
+
+    def close(self):
+        self.unmap()
+        if self.__lock is not None:
+            self.__lock.close()
+        self.__lock = None
+
+    def create(self, filename, slot_size, capacity, records):
+        """ Writes a new archive holding (name, record) pairs.
+        """
+        index = self.header.size + capacity * self.entry.size
+        buf = bytearray(index + capacity * 2 * slot_size)
+        self.header.pack_into(buf, 0, self.magic, self.VERSION, slot_size,
+                              capacity, len(records))
+        for slot, (name, record) in enumerate(records):
+            self.entry.pack_into(buf, self.header.size + slot * self.entry.size,
+                                 name.encode("ascii"))
+            offset = index + slot * 2 * slot_size
+            self.copy.pack_into(buf, offset, 1, len(record))
+            buf[offset + self.copy.size:offset + self.copy.size + len(record)] = record
+        with open(filename + ".tmp", "wb") as f:
+            f.write(buf)
+        os.replace(filename + ".tmp", filename)
+
+    def names(self):
+        with self.locked():
+            return list(self.__index)
+
+    def __contains__(self, name):
+        with self.locked():
+            return name in self.__index
+
+    def __len__(self):
+        with self.locked():
+            return len(self.__index)
+
+    def offset(self, slot, copy=0):
+        return self.header.size + self.capacity * self.entry.size \
+            + (slot * 2 + copy) * self.slot_size
+
+    def copies(self, slot):
+        """ Returns (generation, copy, record) of both copies of a slot,
+        the newest first.
+        """
+        found = []
+        for copy in range(2):
+            offset = self.offset(slot, copy)
+            generation, size = self.copy.unpack_from(self.__map, offset)
+            size = min(size, self.slot_size - self.copy.size)
+            offset += self.copy.size
+            found.append((generation, copy, bytes(self.__map[offset:offset + size])))
+        return sorted(found, reverse=True)
+
+    def newest(self, slot):
+        """ Returns (generation, copy, record) of the newest intact copy
+        of a slot, or None if neither is.
+        """
+        for found in self.copies(slot):
+            if found[0] and self.codec.intact(found[2]):
+                return found
+        return None
+
+    def record(self, name):
+        """ Returns the newest intact packed save of a player.
+        """
+        with self.locked():
+            if name not in self.__index:
+                raise KeyError(name)
+            newest = self.newest(self.__index[name])
+        if newest is None:
+            raise IOError(f"Every save of {name} is corrupted")
+        return newest[2]
+
+    def load(self, name):
+        """ Loads the save of a player. Returns Player and GameWorld.
+        """
+        return self.codec.unpack(self.record(name))
+
+    def save(self, player, world):
+        """ Writes the save of a player over the copy of its slot which
+        is not its newest intact save, taking a new slot for a new player.
+        """
+        with self.locked():
+            record = self.codec.pack(player, world, self.slot_size - self.copy.size)
+            slot = self.__index.get(player.name)
+            if slot is None:
+                if len(self.__index) == self.capacity:
+                    self.grow()
+                slot = len(self.__index)
+                self.copy.pack_into(self.__map, self.offset(slot, 1), 0, 0)
+                self.write(slot, 0, 1, record)
+                self.entry.pack_into(self.__map, self.header.size
+                                     + slot * self.entry.size,
+                                     player.name.encode("ascii"))
+                self.flush(0, self.header.size + (slot + 1) * self.entry.size)
+                # The slot is only taken once the count covers it.
+                self.__index[player.name] = slot
+                self.header.pack_into(self.__map, 0, self.magic, self.VERSION,
+                                      self.slot_size, self.capacity,
+                                      len(self.__index))
+                self.flush(0, self.header.size)
+                return
+            # Never over the copy which would load now.
+            copies = self.copies(slot)
+            newest = self.newest(slot)
+            target = 1 - newest[1] if newest else copies[-1][1]
+            self.write(slot, target, copies[0][0] + 1, record)
+
+    def write(self, slot, copy, generation, record):
+        """ Writes a record into a copy of a slot, and then its
+        generation, so the copy is only newer once it is whole.
+        """
+        offset = self.offset(slot, copy)
+        self.copy.pack_into(self.__map, offset, 0, len(record))
+        start = offset + self.copy.size
+        self.__map[start:start + len(record)] = record
+        self.flush(offset, self.copy.size + len(record))
+        self.copy.pack_into(self.__map, offset, generation, len(record))
+        self.flush(offset, self.copy.size)
+
+    def flush(self, offset, size):
+        """ Flushes the pages of the map a write has touched.
+        """
+        start = offset - offset % mmap.PAGESIZE
+        self.__map.flush(start, min(offset + size, len(self.__map)) - start)
+
+    def grow(self):
+        """ Rewrites the archive with twice as many slots, keeping the
+        newest intact copy of every save. The lock must be held.
+        """
+        records = []
+        for name, slot in self.__index.items():
+            newest = self.newest(slot)
+            if newest is not None:
+                records.append((name, newest[2]))
+        slot_size, capacity = self.slot_size, self.capacity * 2
+        self.unmap()
+        self.create(self.filename, slot_size, capacity, records)
+        self.open()
+
+save_archive = SaveArchive()
+
+class Journal:
+    """ An append-only file of small records of the players, so a crash
+    only loses what happened since the last autosave. A record holds the
+    same values as the record of a save, so the latest record of a
+    player is enough to bring them back over their last save. Records
+    are written by a background thread, append() only packs them, and
+    once the file grows past max_bytes it is compacted to the latest
+    record of every player. Every record is framed by its length and
+    followed by its CRC32. Records are whole snapshots rather than
+    deltas, as a record is only some tens of bytes.
+    """
+    frame = struct.Struct("<H")
+
+    def __init__(self, filename="game.journal", max_bytes=65536, cache=world_cache):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.codec = GameData(cache=cache)
+        self.queue = Queue()
+        self.writer = None
+        self.checked = False
+
+    def append(self, player, world):
+        """ Queues a record of a player to be written.
+        """
+        record = self.codec.record(player, world)
+        self.put(self.frame.pack(len(record)) + record
+                 + struct.pack("<I", zlib.crc32(record)))
+
+    def drop(self, name):
+        """ Queues dropping the records of a player, once a full save of
+        the player is written.
+        """
+        self.put(name)
+
+    def put(self, job):
+        if self.writer is None or not self.writer.is_alive():
+            self.writer = Thread(target=self.write, daemon=True)
+            self.writer.start()
+        self.queue.put(job)
+
+    def flush(self, timeout=5.0):
+        """ Waits until every queued record is written, for up to timeout
+        seconds. Returns whether they all were.
+        """
+        if self.writer is None:
+            return True
+        deadline = time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(left)
+        return True
+
+    def write(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if isinstance(job, str):
+                    self.compact(job)
+                else:
+                    with open(self.filename, "ab") as f:
+                        # Cut off a record torn by a crash, so the ones
+                        # after it can be read.
+                        if not self.checked:
+                            f.truncate(self.scan()[1])
+                            self.checked = True
+                        f.write(job)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    if os.path.getsize(self.filename) > self.max_bytes:
+                        self.compact()
+            except Exception:
+                # Autosave is best effort, a full save still works, and
+                # the writer has to keep going for flush() to return.
+                log.exception("Could not write the journal")
+            finally:
+                self.queue.task_done()
+
+    def read(self):
+        """ Returns the latest intact record of every player by name.
+        """
+        return self.scan()[0]
+
+    def scan(self):
+        """ Reads the journal, returns the latest intact record of every
+        player and where the last whole frame ends. A record failing its
+        checksum is skipped, and a frame torn by a crash ends the scan.
+        """
+        try:
+            with open(self.filename, "rb") as f:
+                data = f.read()
+        except OSError:
+            return {}, 0
+        latest = {}
+        offset = 0
+        while offset + self.frame.size <= len(data):
+            size, = self.frame.unpack_from(data, offset)
+            end = offset + self.frame.size + size + 4
+            if end > len(data):
+                break
+            frame = data[offset:end]
+            record = frame[self.frame.size:-4]
+            offset = end
+            if frame[-4:] != struct.pack("<I", zlib.crc32(record)):
+                continue
+            try:
+                fields, _ = self.codec.read_record(record, 0)
+            except IOError:
+                continue
+            latest[fields[2].decode("ascii")] = (fields, frame)
+        return latest, offset
+
+    def compact(self, drop=None):
+        """ Rewrites the journal with only the latest record of every
+        player, leaving out the player named drop.
+        """
+        records = [frame for name, (_, frame) in self.read().items()
+                   if name != drop]
+        with open(self.filename + ".tmp", "wb") as f:
+            f.write(b"".join(records))
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def names(self):
+        self.flush()
+        return list(self.read())
+
+    def replay(self, name, player=None, world=None):
+        """ Brings a player up to their latest record, if there is one
+        and it is newer than their last save. The region state of world,
+        from that save, is kept.
+        """
+        self.flush()
+        latest = self.read().get(name)
+        if latest is None:
+            return player, world
+        if player is not None and latest[0][0] <= player.saved_at:
+            return player, world
+        replayed, replayed_world = self.codec.build(latest[0])
+        if world is not None:
+            replayed_world.regions = world.regions
+        return replayed, replayed_world
+
+journal = Journal()
@@ -1,28 +1,72 @@
+import math
 import random
-from turtle import Turtle
+from array import array
+from backend import Sprite
 from items import Inventory, SpecialItem
 from cartography import GameWorld, WaterRegion
 import util
 
 class Player:
     """ Abstract class containing universal values for player.
+    Changes to what the HUD shows bump version and the counter of the
+    value in versions, so the HUD only redraws what changed.
     """
     def __init__(self, name: str, world: GameWorld):
+        self.version = 0
+        self.versions = {"score": 0, "hp": 0, "items": 0}
         self.name = name
         self.world = world
-        self.score = 0
+        self.__score = 0
         self.tier = 0
         self.xp = 0
-        self.hp = 5
+        self.__hp = 5
         self.region = world.spawnpoint.copy()
 
-        self.can_swim = False
+        self.__can_swim = False
 
         self.inventory = Inventory(self)
+        # Ticks left of the item effects running when the game was
+        # saved, by item code, resumed once the player is controlled.
+        self.effects = {}
+        # When the save the player was loaded from was made.
+        self.saved_at = 0
 
         self.x = 768 / 2
         self.y = 640 / 2
 
+    def touch(self, name):
+        """ Marks a value shown by the HUD as changed.
+        """
+        self.versions[name] += 1
+        self.version += 1
+
+    @property
+    def score(self):
+        return self.__score
+    @score.setter
+    def score(self, score):
+        if self.__score != score:
+            self.__score = score
+            self.touch("score")
+
+    @property
+    def hp(self):
+        return self.__hp
+    @hp.setter
+    def hp(self, hp):
+        if self.__hp != hp:
+            self.__hp = hp
+            self.touch("hp")
+
+    @property
+    def can_swim(self):
+        return self.__can_swim
+    @can_swim.setter
+    def can_swim(self, can_swim):
+        if self.__can_swim != can_swim:
+            self.__can_swim = can_swim
+            self.touch("items")
+
     def check_exp(self):
         required = [20, 30, 40]
         if self.tier >= 3:
@@ -31,12 +75,12 @@ class Player:
             self.tier += 1
             self.xp = 0
 
-class PlayerController(Turtle):
+class PlayerController(Sprite):
     """ Controller class of a player storing temporal values,
     controlling functions and logic.
     """
     def __init__(self, root, player: Player, x, y):
-        super().__init__("turtle", 0, True)
+        super().__init__(root, "turtle", True)
         self.turtlesize(1.5, 1.5)
         self.color(1, 1, 1)
         self.penup()
@@ -54,6 +98,15 @@ class PlayerController(Turtle):
         self.goto(x, y)
         self.update_coords()
 
+    def enter_region(self):
+        """ Fires when the player walks into another region. Items which
+        work once per region can be used again, effects still running
+        go on until their timers end.
+        """
+        self.drank = False
+        self.lemoned = False
+        self.healed = False
+
     def current_region(self):
         print(self.player.world.get_region(self.player.region[0], self.player.region[1]))
 
@@ -78,6 +131,7 @@ class PlayerController(Turtle):
             self.goto(self.xcor(), self.ycor() - (self.ycor() - 640))
         self.update_coords()
         if self.__new_region:
+            self.__new_region = False
             util.update_region(self.root, self.player, self.player.world)
 
     def move_down(self):
@@ -101,6 +155,7 @@ class PlayerController(Turtle):
             self.goto(self.xcor(), 0.0)
         self.update_coords()
         if self.__new_region:
+            self.__new_region = False
             util.update_region(self.root, self.player, self.player.world)
 
     def move_left(self):
@@ -124,6 +179,7 @@ class PlayerController(Turtle):
             self.goto(0.0, self.ycor())
         self.update_coords()
         if self.__new_region:
+            self.__new_region = False
             util.update_region(self.root, self.player, self.player.world)
 
     def move_right(self):
@@ -147,6 +203,7 @@ class PlayerController(Turtle):
             self.goto(self.xcor() - (self.xcor() - 768), self.ycor())
         self.update_coords()
         if self.__new_region:
+            self.__new_region = False
             util.update_region(self.root, self.player, self.player.world)
 
     def use_item_one(self):
@@ -173,29 +230,20 @@ class PlayerController(Turtle):
             self.player.inventory.active[key - 1].use(self)
 
     def attack(self):
-        """ Fires an attack event and plays an effect with a new Turtle.
+        """ Fires an attack event and plays a slash effect.
         """
         if self.attacking:
             return
         self.attacking = True
         direction = self.heading()
-        particle = Turtle("arrow", 0, False)
-        particle.color("white")
-        particle.speed(0)
-        particle.penup()
-        particle.setheading(direction - 90)
         if direction == 0.0:
-            particle.goto(self.xcor() + 32, self.ycor() + 16)
-            self.attack_particle(particle)
+            self.attack_particle(self.xcor() + 32, self.ycor() + 16, direction - 90)
         if direction == 90.0:
-            particle.goto(self.xcor() - 16, self.ycor() + 32)
-            self.attack_particle(particle)
+            self.attack_particle(self.xcor() - 16, self.ycor() + 32, direction - 90)
         if direction == 180.0:
-            particle.goto(self.xcor() - 32, self.ycor() - 16)
-            self.attack_particle(particle)
+            self.attack_particle(self.xcor() - 32, self.ycor() - 16, direction - 90)
         if direction == 270.0:
-            particle.goto(self.xcor() + 16, self.ycor() - 32)
-            self.attack_particle(particle)
+            self.attack_particle(self.xcor() + 16, self.ycor() - 32, direction - 90)
         self.damage(self.root)
         self.attacking = False
 
@@ -211,47 +259,35 @@ class PlayerController(Turtle):
             pos = [self.xcor() - 32, self.ycor()]
         if direction == 270.0:
             pos = [self.xcor(), self.ycor() - 32]
-        if pos in root.entities.values():
-            sel = [k for k, v in root.entities.items() if v == pos]
-            for e in sel:
-                if isinstance(e, Enemy):
-                    dmg_out = self.player.tier + 1
-                    e.hp -= dmg_out
-                    if not e.dead:
-                        e.check_dead(self.player)
-
-    def attack_particle(self, particle):
-        """ Displays an attack particle.
+        self.hit_enemies(root, pos[0], pos[1])
+
+    def hit_enemies(self, root, x, y):
+        """ Damages the enemies at a position, returns if any was hit.
+        """
+        hit = False
+        for e in root.entities.at(x, y):
+            if isinstance(e, Enemy):
+                dmg_out = self.player.tier + 1
+                e.hp -= dmg_out
+                if not e.dead:
+                    e.check_dead(self.player)
+                    hit = True
+        return hit
+
+    def attack_particle(self, x, y, heading):
+        """ Displays an attack particle, drawn over the next ticks.
         """
-        particle.speed(3)
-        particle.pendown()
-        particle.pensize(8)
-        particle.fd(32)
-        particle.clear()
-        particle.penup()
+        self.root.projectiles.slash(x, y, heading)
 
     def shoot_arrow(self, direction):
-        """ Spawns new Turtle as a moving arrow.
+        """ Fires an arrow which flies over the next ticks until it hits
+        an enemy or leaves the screen.
         """
         if direction not in ["right", "up", "left", "down"]:
             direction = "right"
-        arrow = Turtle("triangle", 0)
         angles = {"right": 0.0, "up": 90.0, "left": 180.0, "down": 270.0}
-        arrow.color("white")
-        arrow.speed(0)
-        arrow.penup()
-        arrow.goto(self.player.x, self.player.y)
-        arrow.setheading(angles[direction])
-        arrow.speed(2)
-        if direction == "right":
-            arrow.fd(abs(768.0 - self.player.x))
-        elif direction == "left":
-            arrow.fd(abs(0.0 - self.player.x))
-        elif direction == "up":
-            arrow.fd(abs(640.0 - self.player.y))
-        elif direction == "down":
-            arrow.fd(abs(0.0 - self.player.y))
-        arrow.ht()
+        self.root.projectiles.arrow(self, self.player.x, self.player.y,
+                                    angles[direction])
 
     def check_dead(self):
         """ Check if the player is dead.
@@ -270,19 +306,281 @@ class PlayerController(Turtle):
     def get_player(self):
         return self.player
 
-class Entity(Turtle):
+class Projectiles:
+    """ Moves attack particles and arrows a fixed distance every tick, so
+    they never hold up the game loop. Their turtles come from the
+    turtle pool of the root and go back once an effect ends.
+    """
+    SLASH_TICKS = 4
+    ARROW_SPEED = 16.0
+
+    def __init__(self, root):
+        self.root = root
+        self.live = []
+
+    def acquire(self, shape):
+        pen = self.root.turtles.acquire(shape)
+        pen.color("white")
+        return pen
+
+    def release(self, pen):
+        self.root.turtles.release(pen)
+
+    def release_all(self):
+        """ Ends every live effect at once.
+        """
+        for shot in self.live:
+            self.release(shot[1])
+        self.live = []
+
+    def slash(self, x, y, heading):
+        """ Draws a 32 pixel slash from x, y over SLASH_TICKS ticks.
+        """
+        pen = self.acquire("arrow")
+        pen.goto(x, y)
+        pen.setheading(heading)
+        pen.pensize(8)
+        pen.pendown()
+        self.live.append(["slash", pen, self.SLASH_TICKS, None])
+
+    def arrow(self, shooter, x, y, heading):
+        """ Fires an arrow from x, y, moving ARROW_SPEED pixels per tick.
+        """
+        pen = self.acquire("triangle")
+        pen.goto(x, y)
+        pen.setheading(heading)
+        pen.showturtle()
+        self.live.append(["arrow", pen, None, shooter])
+
+    def tick(self):
+        """ Advances every live particle and arrow by one tick.
+        """
+        for shot in list(self.live):
+            kind, pen = shot[0], shot[1]
+            if kind == "slash":
+                if shot[2] > 0:
+                    pen.forward(32 / self.SLASH_TICKS)
+                    shot[2] -= 1
+                    continue
+                ended = True
+            else:
+                pen.forward(self.ARROW_SPEED)
+                x, y = round(pen.xcor()), round(pen.ycor())
+                ended = not (0 <= x <= 768 and 0 <= y <= 640)
+                # Entities stand on the 32 pixel grid, so only check there.
+                if not ended and x % 32 == 0 and y % 32 == 0:
+                    ended = shot[3].hit_enemies(self.root, x, y)
+            if ended:
+                self.live.remove(shot)
+                self.release(pen)
+
+class EntityStore:
+    """ Keeps the state of every entity on screen as arrays, one row per
+    entity: position, heading, hp, tier, flags and behaviour timer.
+    Entities are handles to their row, and their turtle is only a view
+    which sync() updates for the rows that changed since the last frame.
+    A spatial hash from 32 pixel tiles to rows is kept up to date on
+    every move, so finding what stands at a position needs no scan.
+    """
+    TILE = 32
+    # Heading turns of a stroll: forward, left, right and around.
+    STROLLS = (0, 90, 270, 180)
+    STEPS = {0: (32.0, 0.0), 90: (0.0, 32.0), 180: (-32.0, 0.0), 270: (0.0, -32.0)}
+    VISIBLE = 1
+    DEAD = 2
+    COLLECTED = 4
+    BRAIN = 8
+
+    def __init__(self, rng=None):
+        self.rng = rng if rng else random.Random()
+        self.clear()
+
+    def clear(self):
+        self.x = array("d")
+        self.y = array("d")
+        self.heading = array("H")
+        self.hp = array("i")
+        self.tier = array("B")
+        self.flags = array("B")
+        self.timer = array("H")
+        self.entities = []
+        self.dirty = set()
+        self.cells = {}
+        self.brains = {}
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __iter__(self):
+        return iter(self.entities)
+
+    def add(self, entity, x, y, hp, flags):
+        """ Adds a row for a new entity and returns its index.
+        """
+        self.x.append(x)
+        self.y.append(y)
+        self.heading.append(0)
+        self.hp.append(hp)
+        self.tier.append(0)
+        self.flags.append(flags)
+        self.timer.append(1)
+        self.entities.append(entity)
+        index = len(self.entities) - 1
+        self.cells.setdefault(self.cell(x, y), set()).add(index)
+        if flags & self.BRAIN:
+            self.brains.setdefault(1, []).append(index)
+        return index
+
+    def set_timer(self, index, timer):
+        """ Sets how many ticks an entity waits between strolls.
+        """
+        if self.flags[index] & self.BRAIN:
+            self.brains[self.timer[index]].remove(index)
+            self.brains.setdefault(timer, []).append(index)
+        self.timer[index] = timer
+
+    def stroll(self, elapsed):
+        """ Advances every living enemy whose timer is due in one batch.
+        Each one walks 32 pixels forward half of the time, unless it
+        would leave the 768x640 playfield, and otherwise turns left,
+        right or around, drawing from the store's Random.
+        """
+        flags, heading, dead = self.flags, self.heading, self.DEAD
+        due = [i for timer, rows in self.brains.items() if elapsed % timer == 0
+               for i in rows if not flags[i] & dead]
+        if not due:
+            return
+        turns = self.rng.choices(self.STROLLS, cum_weights=(3, 4, 5, 6), k=len(due))
+        for i, turn in zip(due, turns):
+            if turn:
+                heading[i] = (heading[i] + turn) % 360
+                self.dirty.add(i)
+                continue
+            dx, dy = self.STEPS[heading[i]]
+            x, y = self.x[i] + dx, self.y[i] + dy
+            if 0.0 <= x <= 768.0 and 0.0 <= y <= 640.0:
+                self.move(i, x, y)
+
+    def cell(self, x, y):
+        return (int(x // self.TILE), int(y // self.TILE))
+
+    def move(self, index, x, y):
+        """ Moves an entity, updating the spatial hash if it changed tile.
+        """
+        old = self.cell(self.x[index], self.y[index])
+        new = self.cell(x, y)
+        if old != new:
+            self.cells[old].discard(index)
+            if not self.cells[old]:
+                del self.cells[old]
+            self.cells.setdefault(new, set()).add(index)
+        self.x[index] = x
+        self.y[index] = y
+        self.dirty.add(index)
+
+    def at(self, x, y):
+        """ Returns the entities standing at a position.
+        """
+        found = self.cells.get(self.cell(x, y))
+        if not found:
+            return []
+        xs, ys = self.x, self.y
+        return [self.entities[i] for i in sorted(found)
+                if xs[i] == x and ys[i] == y]
+
+    def release(self, pool):
+        """ Gives the turtles of every entity back to a TurtlePool.
+        """
+        for e in self.entities:
+            pool.release(e.pen)
+
+    def sync(self):
+        """ Updates the turtles of the entities which changed.
+        """
+        for i in self.dirty:
+            pen = self.entities[i].pen
+            pen.goto(self.x[i], self.y[i])
+            pen.setheading(self.heading[i])
+            if self.flags[i] & self.VISIBLE:
+                pen.showturtle()
+            else:
+                pen.hideturtle()
+        self.dirty.clear()
+
+class Entity:
     """ An entity class for populating the world, with hit() that fires
-    every logic() tick.
+    every logic() tick. Its state lives in the EntityStore of the root,
+    and pen is the turtle drawing it, taken from the turtle pool.
     """
-    def __init__(self, x, y, shape="turtle", hp=0, has_brain=False):
-        super().__init__(shape, 0, True)
-        self.speed(0)
-        self.penup()
-        self.goto(x, y)
-        self.x = x
-        self.y = y
-        self.hp = hp
-        self.has_brain = has_brain
+    def __init__(self, root, x, y, shape="turtle", hp=0, has_brain=False):
+        self.root = root
+        self.store = root.entities
+        flags = EntityStore.VISIBLE
+        if has_brain:
+            flags |= EntityStore.BRAIN
+        self.index = self.store.add(self, x, y, hp, flags)
+        self.pen = root.turtles.acquire(shape)
+        self.pen.goto(x, y)
+        self.pen.showturtle()
+
+    def flag(self, flag, value):
+        if value:
+            self.store.flags[self.index] |= flag
+        else:
+            self.store.flags[self.index] &= ~flag
+        self.store.dirty.add(self.index)
+
+    @property
+    def x(self):
+        return self.store.x[self.index]
+    @x.setter
+    def x(self, x):
+        self.store.move(self.index, x, self.y)
+
+    @property
+    def y(self):
+        return self.store.y[self.index]
+    @y.setter
+    def y(self, y):
+        self.store.move(self.index, self.x, y)
+
+    @property
+    def hp(self):
+        return self.store.hp[self.index]
+    @hp.setter
+    def hp(self, hp):
+        self.store.hp[self.index] = hp
+
+    @property
+    def has_brain(self):
+        return bool(self.store.flags[self.index] & EntityStore.BRAIN)
+
+    def heading(self):
+        return float(self.store.heading[self.index])
+
+    def setheading(self, angle):
+        self.store.heading[self.index] = int(angle) % 360
+        self.store.dirty.add(self.index)
+
+    def left(self, angle):
+        self.setheading(self.heading() + angle)
+
+    def right(self, angle):
+        self.setheading(self.heading() - angle)
+
+    def forward(self, distance):
+        angle = math.radians(self.heading())
+        self.store.move(self.index, self.x + round(math.cos(angle)) * distance,
+                        self.y + round(math.sin(angle)) * distance)
+
+    def isvisible(self):
+        return bool(self.store.flags[self.index] & EntityStore.VISIBLE)
+
+    def showturtle(self):
+        self.flag(EntityStore.VISIBLE, True)
+
+    def hideturtle(self):
+        self.flag(EntityStore.VISIBLE, False)
 
     def hit(self, target):
         """ Fires once the a target is found.
@@ -292,17 +590,24 @@ class Entity(Turtle):
 class ItemEntity(Entity):
     """ Item as entity for player to collect on hit()
     """
-    def __init__(self, x, y, item):
-        super().__init__(x, y, "circle")
+    def __init__(self, x, y, item, root):
+        super().__init__(root, x, y, "circle")
         colors = ["green", "blue", "yellow", "magenta"]
-        self.color(random.choice(colors))
-        self.collected = False
+        self.pen.color(random.choice(colors))
         self.item = item
 
+    @property
+    def collected(self):
+        return bool(self.store.flags[self.index] & EntityStore.COLLECTED)
+    @collected.setter
+    def collected(self, collected):
+        self.flag(EntityStore.COLLECTED, collected)
+
     def hit(self, player):
         if self.collected:
             return
         player.get_player().inventory.add(self.item)
+        player.get_player().world.itemmap[self.item] = 0
         if isinstance(self.item, SpecialItem):
             self.item.use(player)
         self.hideturtle()
@@ -313,13 +618,32 @@ class Enemy(Entity):
     will damage player when hit() works.
     """
     def __init__(self, x, y, tier, root):
-        super().__init__(x, y, "turtle", (tier+1)*2, True)
-        self.color("red")
-        self.turtlesize(1.5, 1.5)
-        self.dead = False
+        super().__init__(root, x, y, "turtle", (tier+1)*2, True)
+        self.pen.color("red")
+        self.pen.turtlesize(1.5, 1.5)
         self.tier = tier
-        self.behavior_seed = random.randint(10, 40)
-        self.root = root
+        self.behavior_seed = self.store.rng.randint(10, 40)
+
+    @property
+    def dead(self):
+        return bool(self.store.flags[self.index] & EntityStore.DEAD)
+    @dead.setter
+    def dead(self, dead):
+        self.flag(EntityStore.DEAD, dead)
+
+    @property
+    def tier(self):
+        return self.store.tier[self.index]
+    @tier.setter
+    def tier(self, tier):
+        self.store.tier[self.index] = tier
+
+    @property
+    def behavior_seed(self):
+        return self.store.timer[self.index]
+    @behavior_seed.setter
+    def behavior_seed(self, behavior_seed):
+        self.store.set_timer(self.index, behavior_seed)
 
     def hit(self, player):
         if player.invincible or self.dead:
@@ -340,43 +664,6 @@ class Enemy(Entity):
             player.set_coords(player.xcor(), player.ycor() - 64)
         player.invincible = False
 
-    def work(self):
-        """ Fires every tick, has dynamic update speed.
-        """
-        if self.root.elapsed % self.behavior_seed == 0:
-            self.random_stroll()
-
-    def random_stroll(self):
-        """ Consider moving or turning.
-        """
-        i = random.randint(0, 1)
-        if i == 0:
-            if self.heading() == 0.0:
-                if self.x + 32.0 > 768.0:
-                    return
-                self.x += 32.0
-            if self.heading() == 90.0:
-                if self.y + 32.0 > 640.0:
-                    return
-                self.y += 32.0
-            if self.heading() == 180.0:
-                if self.x - 32.0 < 0.0:
-                    return
-                self.x -= 32.0
-            if self.heading() == 270.0:
-                if self.y - 32.0 < 0.0:
-                    return
-                self.y -= 32.0
-            self.forward(32)
-        elif i == 1:
-            j = random.randint(0, 2)
-            if j == 0:
-                self.left(90)
-            if j == 1:
-                self.right(90)
-            if j == 2:
-                self.left(180)
-
     def check_dead(self, player):
         """ Check if the enemy is dead.
         """
@@ -386,4 +673,4 @@ class Enemy(Entity):
             player.score += (self.tier + 1) * 100
             if self.tier >= player.tier:
                 player.xp += 1
-            player.check_exp()
\ No newline at end of file
+            player.check_exp()
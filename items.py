@@ -1,5 +1,3 @@
-from threading import Timer
-
 class Item:
     """ Abstract item class with use() method that fires
     with either keybind or event.
@@ -12,6 +10,17 @@ class Item:
     def use(self, player):
         pass
 
+    def remaining(self):
+        """ Returns how many ticks the effect of the item has left.
+        """
+        return 0
+
+    def resume(self, player, ticks):
+        """ Starts the effect of the item again with ticks left, as it
+        was when the game was saved.
+        """
+        pass
+
 class SpecialItem(Item):
     """ Items that are not activatable should use this
     class.
@@ -35,41 +44,66 @@ class Inventory:
         self.items.append(item)
         if not isinstance(item, SpecialItem):
             self.active.append(item)
+        self.owner.touch("items")
+
+class TimedItem(Item):
+    """ Item whose effect wears off after DURATION seconds. The effect
+    is timed on the TimerWheel of the game, so it only runs while the
+    game does, and saves keep how many ticks it has left.
+    """
+    DURATION = 5
+
+    def __init__(self, key, name, description):
+        super().__init__(key, name, description)
+        self.using = False
+        self.timer = None
+
+    def start(self, player, ticks):
+        self.using = True
+        self.timer = player.root.timers.schedule(ticks, self.cancel, player)
 
-class InvincibilityPot(Item):
+    def remaining(self):
+        if not self.using or self.timer is None or self.timer.cancelled:
+            return 0
+        return self.timer.left()
+
+    def cancel(self, player):
+        self.using = False
+
+class InvincibilityPot(TimedItem):
     """ Example active item that can be used with
     a keybind:
     """
     def __init__(self):
         super().__init__("A0", "Invincibility Potion",
                          "Temporal immortality!")
-        self.using = False
 
     def use(self, player):
         if self.using or player.invincible or player.drank: return
-        self.using = True
+        self.resume(player, player.root.ticks(self.DURATION))
+
+    def resume(self, player, ticks):
         player.invincible = True
         player.drank = True
-        t = Timer(5, self.cancel, [player])
-        t.start()
+        self.start(player, ticks)
 
     def cancel(self, player):
         player.invincible = False
         self.using = False
 
-class LemonJuice(Item):
+class LemonJuice(TimedItem):
     
     def __init__(self):
         super().__init__("A1", "Lemon Juice", "Go faster!")
-        self.using = False
 
     def use(self, player):
         if self.using or player.lemoned: return
-        self.using = True
+        self.resume(player, player.root.ticks(self.DURATION))
+
+    def resume(self, player, ticks):
         player.lemoned = True
         player.speedmod = 2
-        t = Timer(5, self.cancel, [player])
-        t.start()
+        self.start(player, ticks)
 
     def cancel(self, player):
         player.speedmod = 1
@@ -94,7 +128,6 @@ class BowArrow(Item):
             direction = "down"
         player.shoot_arrow(direction)
         self.using = False
-        # TODO: Fire arrow to enemy, make a new turtle?
 
 class CannedJellyfish(Item):
     
@@ -115,4 +148,13 @@ class Raft(SpecialItem):
         super().__init__("FF", "Raft", "Traverse the waters!")
 
     def use(self, player):
-        player.get_player().can_swim = True
\ No newline at end of file
+        player.get_player().can_swim = True
+
+def make_item(key):
+    """ Creates a new Item from its item code, e.g. "A0".
+    """
+    for cls in [InvincibilityPot, LemonJuice, BowArrow, CannedJellyfish, Raft]:
+        item = cls()
+        if item.key == key:
+            return item
+    raise ValueError(f"Unknown item code: {key}")
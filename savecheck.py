@@ -0,0 +1,414 @@
+""" Checks TLoT saves against the rules of saveformat.txt, for auditing
+the saves of players after a release. Every file is memory-mapped and
+read as fixed-width struct records, files are checked in parallel and
+every rule a save breaks is reported, not only the first one.
+
+    python savecheck.py [-j JOBS] [-q] PATH...
+
+A PATH may be a ".save" file, a ".saves" archive or a directory, which
+is searched for both. Exits with 1 if any save breaks a rule.
+"""
+import argparse
+import mmap
+import os
+import struct
+import sys
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+MAGIC = b"\x01\x4b\x55\x02"
+SEP = 0x5C
+ITEM_CODES = (0xA0, 0xA1, 0xA2, 0xA3, 0xFF)
+# The size of the worlds of version 1 and legacy saves, version 2 saves
+# record the size of their world.
+WORLD_SIZE = 24
+
+# magic, datetime, seed, sep, name, position, score, tier, sep, can_swim,
+# sep, inventory, sep, then 3 byte world items until the end or a sep.
+LEGACY = struct.Struct("<4s7s20sB16s2s5sBBBB4sB")
+# magic and version, then for version 1 the record, region state length
+# and crc32. Version 2 has varints after the header, read by varint().
+HEAD = struct.Struct("<4sB")
+RECORD = struct.Struct("<Q20s16sBBIBB4s15s")
+LENGTH = struct.Struct("<I")
+# Enemies and items in the state of a region.
+ENEMY_STATE = 12
+ITEM_STATE = 5
+# The header and index entries of a ".saves" archive.
+ARCHIVE = struct.Struct("<4sBHII")
+ENTRY = struct.Struct("<16s")
+# Every slot holds two copies, each a generation, length and save.
+COPY = struct.Struct("<IH")
+
+def bcd(byte):
+    """ Returns the value of a byte written as two decimal digits in
+    hexadecimal, or None if it is not one.
+    """
+    high, low = byte >> 4, byte & 0x0F
+    if high > 9 or low > 9:
+        return None
+    return high * 10 + low
+
+def varint(view, offset):
+    """ Reads a varint of a version 2 save, returns it and the offset
+    after it.
+    """
+    value = shift = 0
+    while True:
+        if offset >= len(view):
+            raise ValueError(f"truncated at byte {offset}")
+        byte = view[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def blob(view, offset):
+    length, offset = varint(view, offset)
+    if offset + length > len(view):
+        raise ValueError(f"truncated at byte {offset}")
+    return bytes(view[offset:offset + length]), offset + length
+
+def check_text(errors, field, raw):
+    text = raw.rstrip(b"\x00")
+    if not text or any(c < 0x20 or c > 0x7E for c in text):
+        errors.append((field, f"not printable ASCII: {raw!r}"))
+
+def check_inventory(errors, inventory):
+    for slot, code in enumerate(inventory):
+        if code and code not in ITEM_CODES:
+            errors.append(("inventory", f"slot {slot + 1} has unknown item {code:02X}"))
+
+def check_state(errors, n, state):
+    """ Checks that the state of a region is as long as its counts say.
+    """
+    if len(state) < 2 or len(state) != 2 + state[0] * ENEMY_STATE + state[1] * ITEM_STATE:
+        errors.append(("regions", f"region {n} has a broken state"))
+
+def check_region_state(errors, view):
+    """ Walks the region state of a version 1 or legacy save without
+    unpacking enemies.
+    """
+    if len(view) < 2:
+        errors.append(("regions", "truncated"))
+        return 0
+    count, = struct.unpack_from("<H", view)
+    offset = 2
+    for n in range(count):
+        if offset + 4 > len(view):
+            errors.append(("regions", f"truncated at region {n}"))
+            return n
+        x, y, length = struct.unpack_from("<BBH", view, offset)
+        offset += 4
+        if x >= WORLD_SIZE or y >= WORLD_SIZE:
+            errors.append(("regions", f"region {n} out of the world: {x}, {y}"))
+        if offset + length > len(view):
+            errors.append(("regions", f"region {n} runs past the end"))
+            return n
+        check_state(errors, n, view[offset:offset + length])
+        offset += length
+    if offset != len(view):
+        errors.append(("regions", f"{len(view) - offset} stray bytes"))
+    return count
+
+def check_legacy(view):
+    """ Checks a save of the older hex format.
+    """
+    errors = []
+    if len(view) < LEGACY.size:
+        return errors + [("size", f"{len(view)} bytes, less than {LEGACY.size}")], {}
+    (magic, stamp, seed, sep1, name, position, score, tier, sep2, swim,
+     sep3, inventory, sep4) = LEGACY.unpack_from(view)
+    for n, sep in enumerate((sep1, sep2, sep3, sep4)):
+        if sep != SEP:
+            errors.append(("separator", f"section {n} ends with {sep:02X}"))
+    if any(bcd(b) is None for b in stamp):
+        errors.append(("datetime", f"not decimal digits: {stamp.hex()}"))
+    check_text(errors, "seed", seed)
+    check_text(errors, "name", name)
+    for axis, byte in zip("xy", position):
+        value = bcd(byte)
+        if value is None or value >= WORLD_SIZE:
+            errors.append(("position", f"{axis} is {byte:02X}, not 00 - 23"))
+    digits = []
+    for n, byte in enumerate(score):
+        if byte > 9:
+            errors.append(("score", f"digit {n} is {byte:02X}, not 00 - 09"))
+        digits.append(min(byte, 9))
+    if tier > 3:
+        errors.append(("tier", f"{tier:02X}, not 00 - 03"))
+    if swim not in (0x00, 0xFF):
+        errors.append(("can_swim", f"{swim:02X}, not 00 or FF"))
+    check_inventory(errors, inventory)
+
+    offset = LEGACY.size
+    items = 0
+    while offset < len(view):
+        if view[offset] == SEP:
+            check_region_state(errors, view[offset + 1:])
+            break
+        if offset + 3 > len(view):
+            errors.append(("world_items", f"{len(view) - offset} stray bytes"))
+            break
+        x, y, code = view[offset:offset + 3]
+        for axis, byte in zip("xy", (x, y)):
+            value = bcd(byte)
+            if value is None or value >= WORLD_SIZE:
+                errors.append(("world_items", f"item {items} {axis} is {byte:02X}"))
+        if code not in ITEM_CODES:
+            errors.append(("world_items", f"item {items} has unknown code {code:02X}"))
+        items += 1
+        offset += 3
+    if items > len(ITEM_CODES):
+        errors.append(("world_items", f"{items} items, more than {len(ITEM_CODES)}"))
+    stats = {"score": int("".join(map(str, reversed(digits)))), "tier": tier}
+    return errors, stats
+
+def check_v1(view):
+    """ Checks a version 1 save, with its fixed struct layout.
+    """
+    errors = []
+    least = HEAD.size + RECORD.size + 2 * LENGTH.size
+    if len(view) < least:
+        return errors + [("size", f"{len(view)} bytes, less than {least}")], {}
+    magic, version = HEAD.unpack_from(view)
+    if magic != MAGIC:
+        errors.append(("magic", f"{bytes(magic).hex()} is not a save"))
+    crc, = LENGTH.unpack_from(view, len(view) - LENGTH.size)
+    if crc != zlib.crc32(view[:len(view) - LENGTH.size]):
+        errors.append(("checksum", "crc32 does not match"))
+    (_, seed, name, x, y, score, tier, swim, inventory,
+     placed) = RECORD.unpack_from(view, HEAD.size)
+    check_text(errors, "seed", seed)
+    check_text(errors, "name", name)
+    if x >= WORLD_SIZE or y >= WORLD_SIZE:
+        errors.append(("position", f"{x}, {y} is out of the world"))
+    if tier > 3:
+        errors.append(("tier", f"{tier:02X}, not 00 - 03"))
+    if swim not in (0x00, 0xFF):
+        errors.append(("can_swim", f"{swim:02X}, not 00 or FF"))
+    check_inventory(errors, inventory)
+    for slot in range(0, 15, 3):
+        code, ix, iy = placed[slot:slot + 3]
+        if code and code not in ITEM_CODES:
+            errors.append(("world_items", f"slot {slot // 3} has unknown code {code:02X}"))
+        if code and (ix >= WORLD_SIZE or iy >= WORLD_SIZE):
+            errors.append(("world_items", f"slot {slot // 3} is out of the world"))
+    offset = HEAD.size + RECORD.size
+    length, = LENGTH.unpack_from(view, offset)
+    offset += LENGTH.size
+    if offset + length + LENGTH.size != len(view):
+        errors.append(("regions", f"length {length} does not match the file"))
+    elif length:
+        check_region_state(errors, view[offset:offset + length])
+    return errors, {"score": score, "tier": tier}
+
+def check_v2(view):
+    """ Checks a version 2 save, made of varints and tables, against the
+    size of the world it records.
+    """
+    errors = []
+    if len(view) < HEAD.size + LENGTH.size:
+        return [("size", f"{len(view)} bytes")], {}
+    crc, = LENGTH.unpack_from(view, len(view) - LENGTH.size)
+    view = view[:len(view) - LENGTH.size]
+    if crc != zlib.crc32(view):
+        errors.append(("checksum", "crc32 does not match"))
+    try:
+        _, offset = varint(view, HEAD.size)
+        seed, offset = blob(view, offset)
+        size, offset = varint(view, offset)
+        tiers = []
+        for _ in range(3):
+            tier, offset = varint(view, offset)
+            tiers.append(tier)
+        generator, offset = varint(view, offset)
+        _, offset = varint(view, offset)
+        name, offset = blob(view, offset)
+        x, offset = varint(view, offset)
+        y, offset = varint(view, offset)
+        score, offset = varint(view, offset)
+        if size < 12:
+            errors.append(("world_size", f"{size}, less than 12"))
+        if not 0 <= tiers[0] < tiers[1] < tiers[2] < 255:
+            errors.append(("tiers", f"{tiers} are not increasing distances"))
+        if generator < 1:
+            errors.append(("generator", f"unknown version {generator}"))
+        check_text(errors, "seed", seed)
+        check_text(errors, "name", name)
+        if x >= size or y >= size:
+            errors.append(("position", f"{x}, {y} is out of the world"))
+        if offset + 2 > len(view):
+            raise ValueError(f"truncated at byte {offset}")
+        tier, swim = view[offset], view[offset + 1]
+        if tier > 3:
+            errors.append(("tier", f"{tier:02X}, not 00 - 03"))
+        if swim not in (0x00, 0xFF):
+            errors.append(("can_swim", f"{swim:02X}, not 00 or FF"))
+        inventory, offset = blob(view, offset + 2)
+        if len(inventory) > 4 or 0 in inventory:
+            errors.append(("inventory", f"{inventory.hex()} is not up to 4 items"))
+        check_inventory(errors, inventory)
+        count, offset = varint(view, offset)
+        if count > len(ITEM_CODES):
+            errors.append(("world_items", f"{count} items, more than {len(ITEM_CODES)}"))
+        for n in range(count):
+            if offset >= len(view):
+                raise ValueError(f"truncated at byte {offset}")
+            code = view[offset]
+            ix, offset = varint(view, offset + 1)
+            iy, offset = varint(view, offset)
+            if code not in ITEM_CODES:
+                errors.append(("world_items", f"item {n} has unknown code {code:02X}"))
+            if ix >= size or iy >= size:
+                errors.append(("world_items", f"item {n} is out of the world"))
+        count, offset = varint(view, offset)
+        for n in range(count):
+            if offset >= len(view):
+                raise ValueError(f"truncated at byte {offset}")
+            code = view[offset]
+            _, offset = varint(view, offset + 1)
+            if code not in inventory:
+                errors.append(("effects", f"effect {n} of {code:02X} is not in the inventory"))
+        count, offset = varint(view, offset)
+        for n in range(count):
+            rx, offset = varint(view, offset)
+            ry, offset = varint(view, offset)
+            state, offset = blob(view, offset)
+            if rx >= size or ry >= size:
+                errors.append(("regions", f"region {n} out of the world: {rx}, {ry}"))
+            check_state(errors, n, state)
+        if offset != len(view):
+            errors.append(("size", f"{len(view) - offset} stray bytes"))
+    except ValueError as e:
+        return errors + [("size", str(e))], {}
+    return errors, {"score": score, "tier": tier}
+
+def check_save(view):
+    if len(view) < 5:
+        return [("size", f"{len(view)} bytes")], {}, "unknown"
+    if bytes(view[:4]) != MAGIC:
+        return [("magic", f"{bytes(view[:4]).hex()} is not a save")], {}, "unknown"
+    # Older saves have the year in BCD after the magic, always 0x20.
+    if view[4] == 0x20:
+        return check_legacy(view) + ("legacy",)
+    if view[4] == 1:
+        return check_v1(view) + ("v1",)
+    if view[4] == 2:
+        return check_v2(view) + ("v2",)
+    return [("version", f"unknown version {view[4]}")], {}, "unknown"
+
+def check_archive(path, view):
+    """ Checks every slot of a ".saves" archive. Of the two copies in a
+    slot, the newest one with a matching checksum is the one checked,
+    as it is the one the game loads.
+    """
+    if len(view) < ARCHIVE.size:
+        return [(path, "unknown", [("size", f"{len(view)} bytes")], {})]
+    magic, version, slot_size, capacity, count = ARCHIVE.unpack_from(view)
+    if magic != b"TLOA" or version != 1:
+        return [(path, "unknown", [("magic", "not a save archive")], {})]
+    slots = ARCHIVE.size + capacity * ENTRY.size
+    if count > capacity or len(view) != slots + capacity * 2 * slot_size:
+        return [(path, "archive", [("size", "does not match its header")], {})]
+    results = []
+    for slot in range(count):
+        name, = ENTRY.unpack_from(view, ARCHIVE.size + slot * ENTRY.size)
+        name = name.rstrip(b"\x00").decode("ascii", "replace")
+        label = f"{path}#{name}"
+        checked = []
+        for copy in range(2):
+            offset = slots + (slot * 2 + copy) * slot_size
+            generation, length = COPY.unpack_from(view, offset)
+            if not generation:
+                continue
+            if length > slot_size - COPY.size:
+                checked.append((generation, [("slot", f"length {length} overflows")], {}))
+                continue
+            start = offset + COPY.size
+            errors, stats, _ = check_save(view[start:start + length])
+            checked.append((generation, errors, stats))
+        if not checked:
+            results.append((label, "archive", [("slot", "has no save")], {}))
+            continue
+        checked.sort(key=lambda c: c[0], reverse=True)
+        intact = [c for c in checked if not any(rule == "checksum" for rule, _ in c[1])]
+        _, errors, stats = (intact or checked)[0]
+        results.append((label, "archive", errors, stats))
+    return results
+
+def check(path):
+    """ Checks a file, returns (label, format, violations, stats) for
+    the save or for every slot of an archive. Regions must lie in the
+    world a save records, or in a 24 by 24 one for older saves.
+    """
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return [(path, "unknown", [("size", "empty file")], {})]
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)
+                try:
+                    if path.endswith(".saves"):
+                        return check_archive(path, view)
+                    errors, stats, fmt = check_save(view)
+                    return [(path, fmt, errors, stats)]
+                finally:
+                    view.release()
+    except OSError as e:
+        return [(path, "unknown", [("io", str(e))], {})]
+
+def find(paths):
+    """ Yields the save files of paths, searching directories.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.endswith((".save", ".saves")):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check TLoT saves.")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="only report saves which break a rule")
+    args = parser.parse_args(argv)
+
+    saves = Counter()
+    formats = Counter()
+    rules = Counter()
+    tiers = Counter()
+    scores = []
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for results in pool.map(check, find(args.paths), chunksize=64):
+            for label, fmt, errors, stats in results:
+                saves["bad" if errors else "ok"] += 1
+                formats[fmt] += 1
+                for rule, detail in errors:
+                    rules[rule] += 1
+                    print(f"{label}: {rule}: {detail}")
+                if not errors:
+                    if not args.quiet:
+                        print(f"{label}: ok")
+                    scores.append(stats["score"])
+                    tiers[stats["tier"]] += 1
+
+    total = saves["ok"] + saves["bad"]
+    print(f"\n{total} saves, {saves['ok']} ok, {saves['bad']} breaking rules")
+    print("formats: " + ", ".join(f"{k} {v}" for k, v in sorted(formats.items())))
+    if rules:
+        print("rules broken: " + ", ".join(f"{k} {v}" for k, v in rules.most_common()))
+    if scores:
+        print(f"score: min {min(scores)}, max {max(scores)}, "
+              f"mean {sum(scores) / len(scores):.1f}")
+        print("tiers: " + ", ".join(f"{k} {tiers[k]}" for k in sorted(tiers)))
+    return 1 if saves["bad"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+class ScheduledCall:
+    """ A callback waiting in a TimerWheel, which can be cancelled
+    before it is due.
+    """
+    def __init__(self, wheel, due, fun, args):
+        self.wheel = wheel
+        self.due = due
+        self.fun = fun
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def left(self):
+        """ Returns how many ticks are left until the call is due.
+        """
+        return max(0, self.due - self.wheel.elapsed)
+
+class TimerWheel:
+    """ Runs callbacks a number of game ticks later, on the game thread.
+    Calls are kept in SLOTS buckets by the tick they are due, so
+    advancing a tick only looks at one bucket. Time only moves when
+    the game steps, so a stalled game loop also holds every timer.
+    """
+    SLOTS = 64
+
+    def __init__(self, elapsed=0):
+        self.elapsed = elapsed
+        self.slots = [[] for _ in range(self.SLOTS)]
+
+    def schedule(self, ticks, fun, *args):
+        """ Calls fun(*args) after a number of ticks, at least one.
+        """
+        call = ScheduledCall(self, self.elapsed + max(1, int(ticks)), fun, args)
+        self.slots[call.due % self.SLOTS].append(call)
+        return call
+
+    def advance(self, elapsed):
+        """ Runs every call which is due until the tick elapsed.
+        """
+        while self.elapsed < elapsed:
+            self.elapsed += 1
+            slot = self.slots[self.elapsed % self.SLOTS]
+            if not slot:
+                continue
+            due = [c for c in slot if c.due == self.elapsed]
+            if not due:
+                continue
+            slot[:] = [c for c in slot if c.due != self.elapsed]
+            for call in due:
+                if not call.cancelled:
+                    call.fun(*call.args)
+
+    def pending(self):
+        """ Returns the calls which are not run or cancelled yet,
+        the soonest first.
+        """
+        calls = [c for slot in self.slots for c in slot if not c.cancelled]
+        return sorted(calls, key=lambda c: c.due)
+
+    def clear(self):
+        """ Cancels every pending call.
+        """
+        for slot in self.slots:
+            for call in slot:
+                call.cancel()
+            slot.clear()
@@ -1,19 +1,146 @@
+import os
+import time
 import random
-import turtle
 import cartography as car
 import entities as ent
 from items import LemonJuice
 import window as win
 import data
 import string
+import struct
+from concurrent.futures import ThreadPoolExecutor
 
 valid_x = [x*32 for x in range(2, 23)]
 valid_y = [x*32 for x in range(2, 19)]
+# Seconds between autosaves into the journal.
+AUTOSAVE = 10
+
+class RegionPlan:
+    """ What a region gets when the player enters it: where its items
+    lie and where its enemies spawn. Nothing here touches
+    turtles, so a plan can be made away from the game thread.
+    """
+    def __init__(self, world, x, y, visit):
+        prng = random.Random(f"{world.seed}:{x}:{y}:{visit}")
+        self.x = x
+        self.y = y
+        self.tier = world.get_tier(x, y)
+        self.items = world.itemmap.at(x, y)
+        self.item_spots = [(prng.choice(valid_x), prng.choice(valid_y))
+                           for _ in self.items]
+        self.enemies = []
+        if [x, y] != world.spawnpoint:
+            self.enemies = [(prng.choice(valid_x), prng.choice(valid_y))
+                            for _ in range(prng.randint(2, 5))]
+
+class Prefetcher:
+    """ Makes the RegionPlan of a neighbouring region on a worker thread
+    once the player comes within EDGE tiles of its border, so entering
+    it only has to place what the plan says. The spawns of a region
+    come from a Random of the world seed, the region and the number of
+    visits, so they are the same whether the plan was prefetched or not.
+    """
+    EDGE = 3
+    executor = None
+
+    def __init__(self, world):
+        self.world = world
+        self.visits = {}
+        self.plans = {}
+        if not Prefetcher.executor:
+            Prefetcher.executor = ThreadPoolExecutor(max_workers=1)
+
+    def neighbours(self, player):
+        """ Returns the regions whose border the player is close to.
+        """
+        margin = self.EDGE * 32
+        x, y = player.region[0], player.region[1]
+        near = []
+        if player.y >= 640 - margin:
+            near.append((x - 1, y))
+        if player.y <= margin:
+            near.append((x + 1, y))
+        if player.x <= margin:
+            near.append((x, y - 1))
+        if player.x >= 768 - margin:
+            near.append((x, y + 1))
+        return [r for r in near if self.world.get_region(r[0], r[1])]
+
+    def prefetch(self, player):
+        """ Starts making the plans of the regions the player is near.
+        """
+        for x, y in self.neighbours(player):
+            if (x, y) not in self.plans and (x, y) not in self.world.regions:
+                visit = self.visits.get((x, y), 0)
+                self.plans[(x, y)] = self.executor.submit(
+                    RegionPlan, self.world, x, y, visit)
+
+    def take(self, x, y):
+        """ Returns the plan of the region being entered, made now if it
+        was not prefetched or its items have changed since. Plans of
+        other regions are dropped.
+        """
+        future = self.plans.pop((x, y), None)
+        for other in self.plans.values():
+            other.cancel()
+        self.plans = {}
+        visit = self.visits.get((x, y), 0)
+        self.visits[(x, y)] = visit + 1
+        if future:
+            plan = future.result()
+            if plan.items == self.world.itemmap.at(x, y):
+                return plan
+        return RegionPlan(self.world, x, y, visit)
+
+ENEMY_STATE = struct.Struct("<HHHhBBH")
+ITEM_STATE = struct.Struct("<BHH")
+
+def pack_region(root):
+    """ Packs the enemies and the items left on the screen, to be put
+    in the RegionCache of the world.
+    """
+    enemies = []
+    items = []
+    store = root.entities
+    for e in store:
+        i = e.index
+        if isinstance(e, ent.Enemy):
+            enemies.append(ENEMY_STATE.pack(int(store.x[i]), int(store.y[i]),
+                                            store.heading[i], store.hp[i],
+                                            store.tier[i], store.flags[i],
+                                            store.timer[i]))
+        elif isinstance(e, ent.ItemEntity) and not e.collected:
+            items.append(ITEM_STATE.pack(int(e.item.key, 16),
+                                         int(store.x[i]), int(store.y[i])))
+    return bytes([len(enemies), len(items)]) + b"".join(enemies + items)
+
+def unpack_region(root, world, state):
+    """ Brings back the enemies and items packed by pack_region().
+    """
+    items = {i.key: i for i in world.itemmap}
+    offset = 2
+    for _ in range(state[0]):
+        x, y, heading, hp, tier, flags, timer = \
+            ENEMY_STATE.unpack_from(state, offset)
+        offset += ENEMY_STATE.size
+        e = ent.Enemy(x, y, tier, root)
+        e.hp = hp
+        e.setheading(heading)
+        e.behavior_seed = timer
+        e.dead = bool(flags & ent.EntityStore.DEAD)
+        if not flags & ent.EntityStore.VISIBLE:
+            e.hideturtle()
+    for _ in range(state[1]):
+        key, x, y = ITEM_STATE.unpack_from(state, offset)
+        offset += ITEM_STATE.size
+        ent.ItemEntity(x, y, items[f"{key:02X}"], root)
 
 def update_region(root, player, world):
     """ Fires when the player goes into a new region,
     the map updates and the screen re-renders with
-    a new map.
+    a new map. The region left is kept in the region
+    cache of the world, and a cached region comes back
+    as it was. The time it took is reported to the root.
     """
     for e in root.entities:
         if isinstance(e, ent.Enemy) and e.isvisible():
@@ -21,41 +148,61 @@ def update_region(root, player, world):
             if player.score <= 0:
                 player.score = 0
     player.hp = 5
-    scr = win.PlayingScreen(root, player, world)
-    root.change_screen(scr)
+    start = time.perf_counter()
+    scr = root.screen
     x, y = player.region[0], player.region[1]
-    if [x, y] in world.itemmap.values():
-        item = [k for k,v in world.itemmap.items() if v == [x, y]]
-        scr.add_entity(ent.ItemEntity(world.get_prng().choice(valid_x),
-                                      world.get_prng().choice(valid_y),
-                                      item[0]))
-        world.itemmap[item[0]] = 0
-    if [x, y] != world.spawnpoint:
-        for _ in range(random.randint(2, 5)):
-            scr.add_entity(ent.Enemy(world.get_prng().choice(valid_x),
-                                    world.get_prng().choice(valid_y),
-                                    world.get_tiermap()[x][y], root))
+    if isinstance(scr, win.PlayingScreen) and scr.player is player:
+        world.regions.put(scr.region[0], scr.region[1], pack_region(root))
+        scr.enter_region(world.get_biome(x, y))
+    else:
+        scr = win.PlayingScreen(root, player, world)
+        root.change_screen(scr)
+        root.timers.schedule(root.ticks(AUTOSAVE), autosave, root, player, world)
+    scr.region = (x, y)
+    state = world.regions.take(x, y)
+    if state is not None:
+        unpack_region(root, world, state)
+    else:
+        plan = scr.prefetcher.take(x, y)
+        for item, (ix, iy) in zip(plan.items, plan.item_spots):
+            ent.ItemEntity(ix, iy, item, root)
+        for ex, ey in plan.enemies:
+            ent.Enemy(ex, ey, plan.tier, root)
+    root.report_timing("region", time.perf_counter() - start)
+
+def autosave(root, player, world):
+    """ Journals the player every AUTOSAVE seconds while they play,
+    if anything a save keeps has changed since the last time.
+    """
+    scr = root.screen
+    if not isinstance(scr, win.PlayingScreen) or scr.player is not player:
+        return
+    state = (player.version, player.tier, tuple(player.region))
+    if state != scr.autosaved:
+        scr.autosaved = state
+        data.journal.append(player, world)
+    root.timers.schedule(root.ticks(AUTOSAVE), autosave, root, player, world)
 
 def new_game(root):
     """ The new game event, takes player name as input
     and creates a new world with random seed.
     """
-    name = turtle.textinput("TLoT",
+    name = root.backend.textinput("TLoT",
                             "Enter a player name (ASCII, max 16 chars):")
     if not name:
         return False
     while True:
         if len(name) > 16 or len(name) <= 0 or \
             any((c not in string.printable) for c in name):
-                name = turtle.textinput("Try again.",
+                name = root.backend.textinput("Try again.",
                             "Enter a player name (ASCII, max 16 chars):")
                 if not name:
                     return False
         else:
             break
 
-    root.save = "game.save"
     world = car.GameWorld()
+    data.world_cache.store(world)
     player = ent.Player(name, world)
     item = LemonJuice()
     player.inventory.add(item)
@@ -63,34 +210,45 @@ def new_game(root):
     return True
 
 def load_game(root):
-    """ The load game event, if "game.save" is not found it takes
-    another file with ".save" extension instead. Then, it
-    regenerates the world and loads player data.
+    """ The load game event. With a single player in the save archive
+    or the journal it is loaded right away, otherwise it asks for a
+    player name. Older ".save" files, "game.save" or the one named,
+    still load and go into the archive on the next save. Autosaves in
+    the journal are replayed over the save.
     """
+    archive = data.save_archive
     try:
-        open("game.save", "rb")
-        dat = data.GameData()
-        root.save = "game.save"
-    except IOError:
-        filename = turtle.textinput("TLoT", "Enter a TLoT .save filename:")
-        if not filename:
-            return False
-        try:
-            open(filename + ".save", "rb")
-            dat = data.GameData(filename + ".save")
-            root.save = filename + ".save"
-        except IOError:
-            return False
-    player, world = dat.load()
+        names = archive.names()
+        names += [n for n in data.journal.names() if n not in names]
+        if len(names) == 1:
+            name = names[0]
+        elif not names and os.path.exists("game.save"):
+            name = "game"
+        else:
+            name = root.backend.textinput("TLoT",
+                            "Enter a player name or a .save filename:")
+            if not name:
+                return False
+        if name in archive:
+            player, world = archive.load(name)
+        elif name in names:
+            player, world = None, None
+        else:
+            player, world = data.GameData(name + ".save").load()
+        player, world = data.journal.replay(name, player, world)
+    except (IOError, ValueError):
+        return False
     update_region(root, player, world)
     return True
 
 def save_game(root, player, world):
-    """ The save game event, creates a new save file.
+    """ The save game event, writes the player into the save archive.
     """
-    dt = data.GameData(root.save)
-    dt.save(player, world)
-    turtle.bye()
+    world.regions.put(player.region[0], player.region[1], pack_region(root))
+    data.save_archive.save(player, world)
+    data.journal.drop(player.name)
+    data.journal.flush()
+    root.backend.bye()
 
 def game_over(root, player):
     """ The medium method for calling the game over screen.
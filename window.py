@@ -1,67 +1,124 @@
-import turtle
 import time
+import random
 import entities
 import cartography as car
 import util
+from timers import TimerWheel
+from backend import TurtleBackend, TurtlePool
 
 class Game:
-    """ The root for the Turtle to run on.
+    """ The root for the Turtle to run on. Drawing goes through backend,
+    a TurtleBackend unless another one such as HeadlessBackend is given.
     """
     def __init__(self, view_width=768, view_height=768,
-                 fps=60.0, title="The Legend of Tao"):
+                 fps=60.0, title="The Legend of Tao", max_frameskip=5,
+                 backend=None, seed=None):
         self.__width = view_width
         self.__height = view_height
         self.__fps = fps
+        self.max_frameskip = max_frameskip
+        self.backend = backend if backend else TurtleBackend()
 
-        turtle.setup(self.__width,
-                     self.__height)
-        turtle.title(title)
-        turtle.tracer(0)
-        turtle.ht()
-        turtle.penup()
-        turtle.setundobuffer(0)
+        self.backend.setup(self.__width, self.__height, title)
 
-        self._time = time.time()
+        self._next_step = time.monotonic()
         self._screen = None
         
         self.elapsed = 0
-        self.entities = {}
-        
-        self.save = ""
+        self.timers = TimerWheel()
+        self.rng = random.Random(seed)
+        self.turtles = TurtlePool(self.backend)
+        self.entities = entities.EntityStore(self.rng)
+        self.projectiles = entities.Projectiles(self)
+
+        self.timings = {}
+        self.timing_hook = None
+
+    @property
+    def running(self):
+        return not self.backend.closed
+
+    @property
+    def screen(self):
+        return self._screen
+
+    def ticks(self, seconds):
+        """ Converts seconds of game time into a number of logic steps.
+        """
+        return round(seconds * self.__fps)
+
+    def report_timing(self, name, seconds):
+        """ Records how long an event such as a region change took, and
+        passes it on to timing_hook if one is set.
+        """
+        self.timings[name] = seconds
+        if self.timing_hook:
+            self.timing_hook(name, seconds)
 
     def tick(self):
-        # Updates the entire game
+        """ Runs the logic steps that are due at a fixed rate of self.__fps,
+        renders once and sleeps until the next step is due. If rendering
+        falls behind, up to max_frameskip steps catch up before the next
+        frame and any older backlog is dropped.
+        """
+        now = time.monotonic()
+        steps = 0
+        while now >= self._next_step and steps < self.max_frameskip:
+            self.step()
+            self._next_step += 1.0 / self.__fps
+            steps += 1
+        if now >= self._next_step:
+            self._next_step = now + 1.0 / self.__fps
         self.update_screen()
+        delay = self._next_step - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def step(self):
+        """ Advances the game logic by a single fixed step.
+        """
+        self.elapsed += 1
+        self.timers.advance(self.elapsed)
         self._screen.logic()
 
     def update_screen(self):
-        # Update frames in a rate of target FPS. (self.__fps)
-        while time.time() < self._time + (1.0 / self.__fps):
-            pass
-        self.elapsed += 1
-        turtle.update()
-        self._time = time.time()
+        self.entities.sync()
+        self.backend.update()
 
     def change_screen(self, screen):
         """ Clear the entire turtle program and renders a new screen.
+        Timers of the old screen, such as item effects, are cancelled.
         """
         if not isinstance(screen, GameScreen):
             raise TypeError(f"{screen} is not a GameScreen")
         self._screen = screen
-        turtle.clearscreen()
-        turtle.setworldcoordinates(0, 0, self.__width, self.__height)
-        self.entities = {}
+        self.timers.clear()
+        self.backend.clearscreen(self.__width, self.__height)
+        self.turtles = TurtlePool(self.backend)
+        self.entities = entities.EntityStore(self.rng)
+        self.projectiles = entities.Projectiles(self)
         screen.makescreen()
-        turtle.listen()
+        self.backend.listen()
 
     def refresh(self):
         """ Clear the entire turtle program and re-renders a screen.
         """
-        turtle.clearscreen()
-        turtle.setworldcoordinates(0, 0, self.__width, self.__height)
-        self.entities = {}
+        self.timers.clear()
+        self.backend.clearscreen(self.__width, self.__height)
+        self.turtles = TurtlePool(self.backend)
+        self.entities = entities.EntityStore(self.rng)
+        self.projectiles = entities.Projectiles(self)
         self._screen.makescreen()
-        turtle.listen()
+        self.backend.listen()
+
+    def reset_entities(self):
+        """ Gives every entity and projectile turtle back to the pool and
+        starts over with empty stores, without clearing the screen.
+        """
+        self.entities.release(self.turtles)
+        self.projectiles.release_all()
+        self.entities = entities.EntityStore(self.rng)
+        self.projectiles = entities.Projectiles(self)
 
 class GameScreen:
     """ A turtle Screen wrapper, with abstract render() and logic() method
@@ -73,7 +130,7 @@ class GameScreen:
         self.bgcolor = bgcolor
 
     def makescreen(self):
-        turtle.bgcolor(self.bgcolor)
+        self.root.backend.bgcolor(self.bgcolor)
         self.render()
 
     def render(self):
@@ -90,7 +147,7 @@ class GameScreen:
         """ Registers keybind to a function
         """
         self.keybinds[key] = description
-        turtle.onkey(event, key)
+        self.root.backend.onkey(event, key)
 
 class MenuScreen(GameScreen):
     """ Menu screen for the game.
@@ -105,7 +162,7 @@ class MenuScreen(GameScreen):
         """ Add a choice to the main menu.
         Creates new turtle and registering it with a label.
         """
-        choice_bullet = turtle.Turtle("circle", 0, False)
+        choice_bullet = self.root.backend.Turtle("circle", 0, False)
         choice_bullet.speed(0)
         choice_bullet.shapesize(1, 1)
         choice_bullet.penup()
@@ -168,10 +225,10 @@ class MenuScreen(GameScreen):
     def exit(self):
         """ Exits the program.
         """
-        turtle.bye()
+        self.root.backend.bye()
 
     def render(self):
-        logo = turtle.Turtle(undobuffersize=0, visible=False)
+        logo = self.root.backend.Turtle(undobuffersize=0, visible=False)
         logo.speed(0)
         logo.color("white")
         logo.penup()
@@ -188,22 +245,36 @@ class MenuScreen(GameScreen):
         self.update()
 
 class PlayingScreen(GameScreen):
-    """ A screen of the gameplay.
+    """ A screen of the gameplay. It stays up while the player walks
+    between regions, enter_region() only swaps what has changed.
     """
     def __init__(self, root, player, world):
         super().__init__(root)
         self.player = player
         self.world = world
         
-        self.curr_score = player.score
-        self.curr_hp = player.hp
-        self.curr_items = player.inventory.active
+        self.hud_version = -1
+        self.seen = {}
+        self.prefetcher = util.Prefetcher(world)
+        self.region = tuple(player.region)
+        self.autosaved = None
+        self.prefetched_at = None
 
     def render(self):
+        self.make_background()
         self.draw_background()
         self.create_player(self.root, self.player.x, self.player.y)
         self.ts, self.th, self.ti = self.draw_ui()
 
+    def enter_region(self, biome):
+        """ Reuses the screen for the region the player is now in.
+        The entities of the old region go back to the turtle pool,
+        the player turtle, HUD and keybinds are kept.
+        """
+        self.root.reset_entities()
+        self.controller.enter_region()
+        self.draw_background(biome)
+
     def create_player(self, root, x, y):
         """ Creates a player at the x, y of screen and assign keybinds.
         """
@@ -218,54 +289,43 @@ class PlayingScreen(GameScreen):
         self.register_keybind("4", self.controller.use_item_four)
         self.register_keybind("space", self.controller.attack)
         self.register_keybind("Escape", self.save)
-
-    def draw_background(self):
-        """ Draws game background with color according to Region types.
+        for item in self.player.inventory.active:
+            if item.key in self.player.effects:
+                item.resume(self.controller, self.player.effects[item.key])
+        self.player.effects = {}
+
+    def make_background(self):
+        """ Makes the background as the shape of a single turtle, an
+        828x720 square from -60, -60. It is made before any other turtle
+        so it stays below them, and is never drawn again.
         """
-        region = self.player.region
-        map_pointer = self.world.get_region(region[0], region[1])
-        color = "white"
-        if isinstance(map_pointer, car.WaterRegion):
-            color = "#64B0FE"
-        elif isinstance(map_pointer, (car.SpawnRegion, car.GrasslandRegion)):
-            color = "#89D900"
-        elif isinstance(map_pointer, (car.PlateauRegion)):
-            color = "#EB9F23"
-        elif isinstance(map_pointer, (car.ForestRegion)):
-            color = "#0D9400"
-        elif isinstance(map_pointer, (car.MountainsRegion)):
-            color = "#666666"
-        elif isinstance(map_pointer, (car.JungleRegion)):
-            color = "#004F08"
-        elif isinstance(map_pointer, (car.SnowRegion)):
-            color = "#48CEDF"
-        elif isinstance(map_pointer, (car.DesertRegion)):
-            color = "#E5E695"
-        painter = turtle.Turtle("circle", 0, False)
-        painter.speed(0)
-        painter.color("black", color)
-        painter.penup()
-        painter.goto(-60, -60)
-        painter.pendown()
-        painter.begin_fill()
-        for _ in range(2):
-            painter.forward(828)
-            painter.left(90)
-            painter.forward(720)
-            painter.left(90)
-        painter.end_fill()
-
-    def add_entity(self, entity):
-        """ Register new entity to the screen for tracking.
+        self.background = self.root.backend.Turtle("square", 0, False)
+        self.background.speed(0)
+        self.background.penup()
+        # The square shape is 20 pixels wide, stretched to cover the map.
+        self.background.shapesize(720 / 20, 828 / 20, 1)
+        self.background.goto(-60 + 828 / 2, -60 + 720 / 2)
+        self.background_color = None
+
+    def draw_background(self, biome=None):
+        """ Colours the game background according to Region types.
+        Only the fill colour of the background changes between regions.
         """
-        self.root.entities[entity] = [entity.x, entity.y]
+        if biome is None:
+            region = self.player.region
+            biome = self.world.get_biome(region[0], region[1])
+        color = car.BIOME_COLORS[biome]
+        if color != self.background_color:
+            self.background_color = color
+            self.background.color("black", color)
+        self.background.showturtle()
 
     def draw_ui(self):
         """ Draws UI components.
         """
-        score = turtle.Turtle("circle", 0, False)
-        hp = turtle.Turtle("circle", 0, False)
-        items = turtle.Turtle("circle", 0, False)
+        score = self.root.backend.Turtle("circle", 0, False)
+        hp = self.root.backend.Turtle("circle", 0, False)
+        items = self.root.backend.Turtle("circle", 0, False)
         score.penup()
         hp.penup()
         items.penup()
@@ -276,11 +336,9 @@ class PlayingScreen(GameScreen):
         hp.speed(0)
         items.speed(0)
         score.goto(384, 700)
-        score.write(str(self.curr_score), align="center", font=("Arial", 24, "normal"))
         hp.goto(192, 700)
-        hp.write(f"HP: {self.curr_hp}", align="left", font=("Arial", 12, "normal"))
         items.goto(576, 700)
-        items.write(self.construct_items_string(), align="right", font=("Arial", 12, "normal"))
+        self.update_ui(score, hp, items)
         return score, hp, items
         
     def construct_items_string(self):
@@ -296,24 +354,27 @@ class PlayingScreen(GameScreen):
         return res
 
     def update_ui(self, score, hp, items):
-        """ Updates UI components every tick.
+        """ Redraws the UI components whose value changed since they
+        were last drawn, going by the versions of the player.
         """
-        if self.curr_score != self.player.score:
-            self.curr_score = self.player.score
+        versions = self.player.versions
+        self.hud_version = self.player.version
+        if self.seen.get("score") != versions["score"]:
+            self.seen["score"] = versions["score"]
             score.clear()
-            score.write(str(self.curr_score), align="center", font=("Arial", 24, "normal"))
-        if self.curr_hp != self.player.hp:
-            self.curr_hp = self.player.hp
-            if self.curr_hp <= 1:
+            score.write(str(self.player.score), align="center", font=("Arial", 24, "normal"))
+        if self.seen.get("hp") != versions["hp"]:
+            self.seen["hp"] = versions["hp"]
+            if self.player.hp <= 1:
                 hp.color("red")
             else:
                 hp.color("white")
             hp.clear()
-            hp.write(f"HP: {self.curr_hp}", align="left", font=("Arial", 12, "normal"))
-        if self.curr_items != self.player.inventory.items:
-            self.curr_items = self.player.inventory.items
+            hp.write(f"HP: {self.player.hp}", align="left", font=("Arial", 12, "normal"))
+        if self.seen.get("items") != versions["items"]:
+            self.seen["items"] = versions["items"]
             items.clear()
-            items.write(self.construct_items_string(), align="right", font=("Arial", 12, "normal"))            
+            items.write(self.construct_items_string(), align="right", font=("Arial", 12, "normal"))
 
     def save(self):
         """ Fires a save game event.
@@ -321,17 +382,16 @@ class PlayingScreen(GameScreen):
         util.save_game(self.root, self.player, self.world)
 
     def logic(self):
-        self.update_ui(self.ts, self.th, self.ti)
-        if len(self.root.entities) != 0:
-            for e in self.root.entities:
-                self.root.entities[e] = [e.x, e.y]
-                if e.has_brain:
-                    e.work()
-            pos = [self.player.x, self.player.y]
-            if pos in self.root.entities.values():
-                sel = [k for k, v in self.root.entities.items() if v == pos]
-                for e in sel:
-                    e.hit(self.controller)
+        if self.hud_version != self.player.version:
+            self.update_ui(self.ts, self.th, self.ti)
+        self.root.projectiles.tick()
+        if self.prefetched_at != (self.player.x, self.player.y):
+            self.prefetched_at = (self.player.x, self.player.y)
+            self.prefetcher.prefetch(self.player)
+        store = self.root.entities
+        store.stroll(self.root.elapsed)
+        for e in store.at(self.player.x, self.player.y):
+            e.hit(self.controller)
 
 class GameOverScreen(GameScreen):
     """ A screen displaying Game Over in red and final score.
@@ -341,7 +401,7 @@ class GameOverScreen(GameScreen):
         self.player = player
 
     def render(self):
-        title = turtle.Turtle("circle", 0, False)
+        title = self.root.backend.Turtle("circle", 0, False)
         title.speed(0)
         title.penup()
         title.goto(384, 384)
@@ -360,4 +420,4 @@ class GameOverScreen(GameScreen):
         self.register_keybind("Escape", self.exit)
         
     def exit(self):
-        turtle.bye()
\ No newline at end of file
+        self.root.backend.bye()
\ No newline at end of file